@@ -1,9 +1,10 @@
+import pandas as pd
 import streamlit as st
 from utils.data_viz import show_timelines
-from utils.utility_functions import compute_kpis, get_customers_heatmap
+from utils.utility_functions import compute_kpis, get_customers_heatmap, get_geo_cube
 
 
-def geodemographic_profiling_main_function(address, directory, sales_filter, customer_type,
+def geodemographic_profiling_main_function(directory, sales_filter, customer_type,
                                            snapshot_start_date, snapshot_end_date):
     st.subheader(f'Geographical distribution of Customers', divider='grey')
     st.info(f'Company: :blue[{directory}]' +
@@ -13,12 +14,13 @@ def geodemographic_profiling_main_function(address, directory, sales_filter, cus
     address_type = st.radio('Address type', ['Invoice', 'Delivery'], horizontal=True)
 
     if address_type == 'Invoice':
-        address = address[(address['Address_type'] == 'INVOICE') | (address['Address_type'] == 'BOTH')]
+        address_types = ['INVOICE', 'BOTH']
     elif address_type == 'Delivery':
-        address = address[(address['Address_type'] == 'DELIVERY') | (address['Address_type'] == 'BOTH')]
-    try:
-        get_customers_heatmap(address)
-    except AttributeError:
+        address_types = ['DELIVERY', 'BOTH']
+    geo_cube = get_geo_cube(customer_type, sales_filter, snapshot_start_date, snapshot_end_date, directory)
+    if geo_cube.columns.isin(address_types).any():
+        get_customers_heatmap(geo_cube, address_types)
+    else:
         st.error('No address for the selected filter !')
     return
 
@@ -40,3 +42,16 @@ def home_main_function(invoices, orders, customers, products, categories, cltv_d
     show_timelines(directory, snapshot_start_date, snapshot_end_date)
 
     return
+
+
+def show_lifetime_values(lifetime_values):
+    st.subheader('Lifetime value by horizon (legacy formula)', divider='grey')
+    st.caption('Average purchase value x purchase frequency / churn rate x margin. The Lifetime Value metric above is '
+               'predicted by the BG/NBD and Gamma-Gamma model.')
+    averages = lifetime_values.drop(columns='Customer_ID').mean()
+    horizons = list(dict.fromkeys(column.split('_')[2] for column in averages.index))
+    averages.index = pd.MultiIndex.from_tuples([tuple(column.split('_')[1:]) for column in averages.index],
+                                               names=['Data type', 'Horizon'])
+    averages = averages.unstack('Horizon')[horizons]
+    st.dataframe(averages.round(2))
+    return averages
@@ -3,13 +3,21 @@ import datetime
 import pandas as pd
 import streamlit as st
 from mba import mba_main_function
-from home_functions import home_main_function, geodemographic_profiling_main_function
+from home_functions import home_main_function, geodemographic_profiling_main_function, show_lifetime_values
 from rfm_segmentation_functions import rfm_main_function
 from mba_statistics import mba_statistics_main_function
-from utils.get_data import filter_data, get_dates
+from utils.get_data import filter_data, get_dates, get_memory_report, get_sales_facts, get_database_url, \
+    get_customer_aggregates, get_horizon_aggregates, is_streaming
 from overview_functions import overview_main_function
+from warm_up import start_warm_up
 from utils.authentification import get_auth_status, render_login_form, get_user_type, logout
-from utils.utility_functions import compute_lifetime_value
+from utils.utility_functions import compute_lifetime_value, compute_lifetime_values, get_cltv_model, CLTV_HORIZONS
+
+# Cached frames are handed out as shallow copies: copy-on-write keeps writes to them from reaching the shared store
+pd.set_option('mode.copy_on_write', True)
+
+STREAMING_WARNING = ('The sales lines of this company are too large to be loaded in memory: only the views based on '
+                     'per-customer aggregates are available.')
 
 
 def get_folder_names(directory):
@@ -75,40 +83,48 @@ def data_main():
         df_sales = orders
         df_lines = orders_lines
 
-    if not df_sales.empty and not df_lines.empty:
+    streaming = is_streaming(directory)
+
+    if not df_sales.empty and (streaming or not df_lines.empty):
+        customer_aggregates = get_customer_aggregates(customer_type, sales_filter, snapshot_start_date,
+                                                      snapshot_end_date, directory, True, True)
+
         with home_tab:
-            cltv_df = compute_lifetime_value(df_sales, df_lines, sales_filter)
+            cltv_model = get_cltv_model(customer_type, sales_filter, snapshot_start_date, snapshot_end_date, directory)
+            cltv_df = compute_lifetime_value(customer_aggregates, cltv_model, snapshot_end_date)
             home_main_function(invoices, orders, customers, products, categories, cltv_df, customer_type,
                                snapshot_start_date, snapshot_end_date, directory)
+            show_lifetime_values(compute_lifetime_values(get_horizon_aggregates(
+                customer_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, True, True,
+                CLTV_HORIZONS)))
+            if not get_database_url(directory):
+                with st.expander('Memory usage of the loaded tables'):
+                    st.dataframe(get_memory_report(directory))
 
         with geo_tab:
-            geodemographic_profiling_main_function(address, directory, sales_filter, customer_type,
+            geodemographic_profiling_main_function(directory, sales_filter, customer_type,
                                                    snapshot_start_date, snapshot_end_date)
 
         with rfm_seg_tab:
             rfm, ml_clusters, segment_1_clusters, segment_2_clusters = rfm_main_function(
-                df_sales, snapshot_end_date, customers, directory,
+                snapshot_end_date, customers, directory,
                 snapshot_start_date, sales_filter, customer_type)
 
+        if streaming:
+            with mba_tab:
+                st.warning(STREAMING_WARNING)
+            with customer_tab:
+                st.warning(STREAMING_WARNING)
+            return
+
         with mba_tab:
-            _, _, _, invoices_, invoices_lines_, orders_, orders_lines_, _ = filter_data(
-                customer_type,
-                sales_filter,
-                snapshot_start_date,
-                snapshot_end_date,
-                directory, False, False)
-
-            if sales_filter == 'Invoice':
-                df_sales = invoices_
-                df_lines = invoices_lines_
-            else:
-                df_sales = orders_
-                df_lines = orders_lines_
+            all_sales_facts = get_sales_facts(customer_type, sales_filter, snapshot_start_date, snapshot_end_date,
+                                              directory, False, False)
 
             product_clusters, category_clusters, product_grouped_df, category_grouped_df, \
             product_recommendation, category_recommendation, recommendations_ubcf, recommendations_ubcfc, \
             recommendations_ibcf, recommendations_ibcfc = mba_main_function(
-                df_sales, df_lines, products, categories, customers, directory, sales_filter, customer_type)
+                all_sales_facts, products, categories, customers, directory, customer_type)
 
         with customer_tab:
             overview_data = pd.merge(rfm, product_clusters.reset_index()[['Customer_ID', 'Cluster MBA']],
@@ -119,7 +135,7 @@ def data_main():
             overview_data = overview_data.rename(columns={'Cluster MBA': 'Category cluster MBA'})
             overview_data = pd.merge(overview_data, cltv_df, on='Customer_ID')
 
-            overview_main_function(address, overview_data, ml_clusters, segment_1_clusters, segment_2_clusters,
+            overview_main_function(overview_data, ml_clusters, segment_1_clusters, segment_2_clusters,
                                    product_grouped_df, category_grouped_df, product_recommendation,
                                    category_recommendation, recommendations_ubcf, recommendations_ubcfc,
                                    recommendations_ibcf, recommendations_ibcfc, directory, snapshot_start_date,
@@ -147,12 +163,25 @@ def marketing_main():
         df_sales = orders
         df_lines = orders_lines
 
-    if not df_sales.empty and not df_lines.empty:
+    streaming = is_streaming(directory)
+
+    if not df_sales.empty and (streaming or not df_lines.empty):
         with statistics_tab:
-            cltv_df = compute_lifetime_value(df_sales, df_lines, sales_filter)
+            customer_aggregates = get_customer_aggregates(customer_type, sales_filter, snapshot_start_date,
+                                                          snapshot_end_date, directory, True, True)
+            cltv_model = get_cltv_model(customer_type, sales_filter, snapshot_start_date, snapshot_end_date, directory)
+            cltv_df = compute_lifetime_value(customer_aggregates, cltv_model, snapshot_end_date)
             home_main_function(invoices, orders, customers, products, categories, cltv_df, customer_type,
                                snapshot_start_date, snapshot_end_date, directory)
-            mba_statistics_main_function(df_sales, df_lines, products, categories, sales_filter)
+            show_lifetime_values(compute_lifetime_values(get_horizon_aggregates(
+                customer_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, True, True,
+                CLTV_HORIZONS)))
+            if streaming:
+                st.warning(STREAMING_WARNING)
+            else:
+                sales_facts = get_sales_facts(customer_type, sales_filter, snapshot_start_date, snapshot_end_date,
+                                              directory, True, True)
+                mba_statistics_main_function(sales_facts)
 
         with overview_tab:
             try:
@@ -193,7 +222,7 @@ def marketing_main():
                     './Results/' + directory + '/recommendations_ibcfc' + sales_filter + '_' + customer_type + '_' + str(
                         snapshot_start_date) + '_' + str(snapshot_end_date) + '.csv')
 
-                overview_main_function(address, overview_data, ml_clusters, segment_1_clusters, segment_2_clusters,
+                overview_main_function(overview_data, ml_clusters, segment_1_clusters, segment_2_clusters,
                                        product_grouped_df, category_grouped_df, product_recommendation,
                                        category_recommendation, recommendations_ubcf, recommendations_ubcfc,
                                        recommendations_ibcf, recommendations_ibcfc, directory, snapshot_start_date,
@@ -211,6 +240,7 @@ def marketing_main():
 def main():
     st.set_page_config(page_title='Customer Portrait', layout='centered')
     st.title(f'Customer Portrait')
+    start_warm_up(tuple(get_folder_names('./data')))
 
     if not get_auth_status():
         user = render_login_form()
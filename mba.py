@@ -80,7 +80,7 @@ def show_mba(product_clusters, category_clusters, apriori_rules_products, aprior
     return product_grouped_df, category_grouped_df, product_recommendation, category_recommendation
 
 
-def mba_main_function(df_sales, df_lines, products, categories, customers, directory, sales_filter, customer_type):
+def mba_main_function(sales_facts, products, categories, customers, directory, customer_type):
     mba_statistics, prod_aff_tab, most_freq_tab, product_pred_tab, data_tab = st.tabs(
         ['Statistics', 'Product affinity', 'Most Frequent Pattern', 'Recommendations', 'Download data'])
     with mba_statistics:
@@ -89,7 +89,7 @@ def mba_main_function(df_sales, df_lines, products, categories, customers, direc
                 f'\n\nData type: All data were used' +
                 f'\n\nCustomer type: :blue[{customer_type}]' +
                 f'\n\nDate range: All data were used', icon='ℹ️')
-        mba_statistics_main_function(df_sales, df_lines, products, categories, sales_filter)
+        mba_statistics_main_function(sales_facts)
     with prod_aff_tab:
         st.header(f'Basket Clusters', divider='grey')
         st.info(f'Company: :blue[{directory}]' +
@@ -97,17 +97,14 @@ def mba_main_function(df_sales, df_lines, products, categories, customers, direc
                 f'\n\nCustomer type: :blue[{customer_type}]' +
                 f'\n\nDate range: All data were used', icon='ℹ️')
         data_filter = st.radio('Analyze the Data based on', ['Quantity', 'Total_price'], horizontal=True)
-        product_clusters, category_clusters = prod_aff_main_function(df_sales, df_lines, categories, products,
-                                                                     sales_filter, data_filter)
+        product_clusters, category_clusters = prod_aff_main_function(sales_facts, data_filter)
     with most_freq_tab:
         st.header(f'Most Frequent Pattern', divider='grey')
         st.info(f'Company: :blue[{directory}]' +
                 f'\n\nData type: All data were used' +
                 f'\n\nCustomer type: :blue[{customer_type}]' +
                 f'\n\nDate range: All data were used', icon='ℹ️')
-        apriori_rules_products, apriori_rules_categories = most_frequent_pattern_main_function(df_lines, products,
-                                                                                               categories,
-                                                                                               sales_filter)
+        apriori_rules_products, apriori_rules_categories = most_frequent_pattern_main_function(sales_facts)
     with product_pred_tab:
         st.header(f'Recommendations', divider='grey')
         st.info(f'Company: :blue[{directory}]' +
@@ -115,10 +112,10 @@ def mba_main_function(df_sales, df_lines, products, categories, customers, direc
                 f'\n\nCustomer type: :blue[{customer_type}]' +
                 f'\n\nDate range: All data were used', icon='ℹ️')
         next_prod_pred_main_function(apriori_rules_products, apriori_rules_categories, products, categories,
-                                     customers, df_sales, df_lines)
+                                     customers, sales_facts)
     with data_tab:
         recommendations_ubcf, recommendations_ubcfc, recommendations_ibcf, recommendations_ibcfc = get_all_recommendations(
-            customers, products, categories, df_sales, df_lines)
+            customers, products, categories, sales_facts)
         product_grouped_df, category_grouped_df, product_recommendation, category_recommendation = show_mba(
             product_clusters, category_clusters, apriori_rules_products, apriori_rules_categories, recommendations_ubcf, recommendations_ubcfc, recommendations_ibcf, recommendations_ibcfc)
 
@@ -3,18 +3,15 @@ import plotly.express as px
 
 
 @st.cache_data
-def show_eda(df_sales, df_lines, products, categories, sales_filter):
-    df = df_sales.merge(df_lines, on=sales_filter + '_ID')
-    new_df = df.groupby(sales_filter + '_ID').agg(
+def show_eda(sales_facts):
+    new_df = sales_facts.groupby('Sale_ID').agg(
         {'Product_ID': lambda x: len(x)}).reset_index().sort_values(['Product_ID'])
     fig = px.box(new_df, x="Product_ID").update_layout(xaxis_title='Number of items', title='Basket Size')
     st.write(fig)
 
-    quantity_data = df_lines.groupby('Product_ID')['Quantity'].sum().reset_index().merge(products, on='Product_ID').groupby(
-        'Product_name')['Quantity'].sum().reset_index()[['Product_name', 'Quantity']]
+    quantity_data = sales_facts.groupby('Product_name', observed=True)['Quantity'].sum().reset_index()
     quantity_data.sort_values('Quantity', ascending=False, inplace=True)
-    price_data = df_lines.groupby('Product_ID')['Total_price'].sum().reset_index().merge(products, on='Product_ID').groupby(
-        'Product_name')['Total_price'].sum().reset_index()[['Product_name', 'Total_price']]
+    price_data = sales_facts.groupby('Product_name', observed=True)['Total_price'].sum().reset_index()
     price_data.sort_values('Total_price', ascending=False, inplace=True)
 
     fig = px.bar(quantity_data.head(10), x='Quantity', y='Product_name',
@@ -35,13 +32,9 @@ def show_eda(df_sales, df_lines, products, categories, sales_filter):
                                                 xaxis_title='Price', yaxis_title='Products')
     st.write(fig)
 
-    quantity_data = df_lines.groupby('Product_ID')['Quantity'].sum().reset_index().merge(
-        products, on='Product_ID').merge(categories, on='Category_ID').groupby(
-        'Category_name')['Quantity'].sum().reset_index()[['Category_name', 'Quantity']]
+    quantity_data = sales_facts.groupby('Category_name', observed=True)['Quantity'].sum().reset_index()
     quantity_data.sort_values('Quantity', ascending=False, inplace=True)
-    price_data = df_lines.groupby('Product_ID')['Total_price'].sum().reset_index().merge(
-        products, on='Product_ID').merge(categories, on='Category_ID').groupby(
-        'Category_name')['Total_price'].sum().reset_index()[['Category_name', 'Total_price']]
+    price_data = sales_facts.groupby('Category_name', observed=True)['Total_price'].sum().reset_index()
     price_data.sort_values('Total_price', ascending=False, inplace=True)
 
     fig = px.bar(quantity_data.head(10), x='Quantity', y='Category_name',
@@ -65,6 +58,6 @@ def show_eda(df_sales, df_lines, products, categories, sales_filter):
     return
 
 
-def mba_statistics_main_function(df_sales, df_lines, products, categories, sales_filter):
+def mba_statistics_main_function(sales_facts):
 
-    show_eda(df_sales, df_lines, products, categories, sales_filter)
+    show_eda(sales_facts)
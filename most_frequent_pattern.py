@@ -1,48 +1,28 @@
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import streamlit as st
-from mlxtend.preprocessing import TransactionEncoder
-from mlxtend.frequent_patterns import apriori, association_rules, fpgrowth
+from scipy import sparse
+from mlxtend.frequent_patterns import association_rules, fpgrowth
 
 
 @st.cache_data
-def clean_data(df_lines, products, categories, sales_filter, mode):
-    data = df_lines.merge(products, on='Product_ID').merge(categories, on='Category_ID').groupby(
-        sales_filter + '_ID')[mode + '_name'].apply(lambda x: list(set(x))).to_frame()
-    data = list(data[mode + '_name'])
-
-    te = TransactionEncoder()
-    te_ary = te.fit(data).transform(data)
-    df = pd.DataFrame(te_ary, columns=te.columns_)
+def clean_data(sales_facts, mode):
+    # One sparse boolean row per sale and column per item, built from integer codes: the baskets are never turned into
+    # Python lists nor into a dense matrix
+    # Products and categories were both inner-joined: lines of a product without a category are left out in both modes
+    sales_facts = sales_facts.dropna(subset=['Product_name', 'Category_name'])
+    sale_codes, sales = pd.factorize(sales_facts['Sale_ID'], sort=True)
+    item_codes, items = pd.factorize(sales_facts[mode + '_name'], sort=True)
+    baskets = sparse.csr_matrix((np.ones(len(sales_facts), dtype=bool), (sale_codes, item_codes)),
+                                shape=(len(sales), len(items)))
+    # Booleans only get a valid fill value as a SparseDtype of their own: the matrix is read as 0/1 integers first
+    df = pd.DataFrame.sparse.from_spmatrix(baskets.astype(np.uint8), columns=list(items)).astype(
+        pd.SparseDtype(bool, False))
 
     return df
 
 
-@st.cache_resource
-def apriori_approach(df, min_support=0.001, metric="confidence", min_threshold=0.01):
-    apriori_res = apriori(df, min_support=min_support, use_colnames=True).sort_values(by="support", ascending=False)
-    bar_data = apriori_res[:5].copy()
-    bar_data.loc[:, 'itemsets'] = bar_data['itemsets'].apply(list).astype(str)
-    fig = px.bar(x=bar_data['itemsets'], y=bar_data['support'],
-                 labels={'x': 'Product', 'y': 'Support value'}).update_layout(
-        title='Top 5 Association Rules by Support Value')
-    st.write(fig)
-
-    rules = association_rules(apriori_res, metric=metric, min_threshold=min_threshold).sort_values(by='confidence',
-                                                                                                   ascending=False)
-    rules['antecedents items'] = rules['antecedents'].apply(lambda x: len(x))
-    rules['consequents items'] = rules['consequents'].apply(lambda x: len(x))
-    rules['antecedents_'] = rules['antecedents'].apply(lambda a: ','.join(list(a)))
-    rules['consequents_'] = rules['consequents'].apply(lambda a: ','.join(list(a)))
-
-    pivot = rules[(rules['antecedents items'] == 1) & (rules['consequents items'] == 1)].pivot(index='antecedents_',
-                                                                                               columns='consequents_',
-                                                                                               values=metric)
-    fig = px.imshow(pivot).update_layout(title='Association Rules with Single Antecedents and Consequents')
-    st.write(fig)
-    return apriori_res, rules
-
-
 @st.cache_resource
 def fpgrowth_approach(df, min_support=0.001, metric='lift', min_threshold=0.01):
     fpgrowth_res = fpgrowth(df, min_support=min_support, use_colnames=True).sort_values(by="support", ascending=False)
@@ -68,9 +48,9 @@ def fpgrowth_approach(df, min_support=0.001, metric='lift', min_threshold=0.01):
     return fpgrowth_res, rules
 
 
-def most_frequent_pattern_main_function(df_lines, products, categories, transformed_sales_filter):
-    df_products = clean_data(df_lines, products, categories, transformed_sales_filter, 'Product')
-    df_categories = clean_data(df_lines, products, categories, transformed_sales_filter, 'Category')
+def most_frequent_pattern_main_function(sales_facts):
+    df_products = clean_data(sales_facts, 'Product')
+    df_categories = clean_data(sales_facts, 'Category')
 
     st.subheader('Fine-tuning Models: Hyperparameter Optimization', divider='grey')
     col1, col2, col3 = st.columns(3)
@@ -92,12 +72,15 @@ def most_frequent_pattern_main_function(df_lines, products, categories, transfor
         st.write(
             "***Zhang's metric ->*** measure designed to assess the strength of association (positive or negative) between two items, taking into account both their co-occurrence and their non-co-occurrence.")
 
+    # FP-growth reads the baskets row by row from the sparse matrix, where apriori would build a dense boolean array of
+    # baskets by candidate itemsets. Both find the same itemsets
     st.subheader('Results: Most Frequent Pattern', divider='grey')
     with st.expander('For Products'):
-        apriori_mfp_products, apriori_rules_products = apriori_approach(df_products, min_support, metric, min_threshold)
+        fpgrowth_mfp_products, fpgrowth_rules_products = fpgrowth_approach(df_products, min_support, metric,
+                                                                           min_threshold)
 
     with st.expander('For Categories'):
-        apriori_mfp_categories, apriori_rules_categories = apriori_approach(df_categories, min_support, metric,
-                                                                            min_threshold)
+        fpgrowth_mfp_categories, fpgrowth_rules_categories = fpgrowth_approach(df_categories, min_support, metric,
+                                                                               min_threshold)
 
-    return apriori_rules_products, apriori_rules_categories
+    return fpgrowth_rules_products, fpgrowth_rules_categories
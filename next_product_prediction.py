@@ -19,17 +19,21 @@ def associative_rule_learning(df, item):
 
 
 @st.cache_data
-def user_based_collaborative_filtering(products, df_sales, df_lines, customer_id, num_recommendations=3):
+def get_normalized_matrix(sales_facts, mode):
     data_filter = 'Quantity'
-    sales_filter = 'Invoice'
 
-    df_all = df_sales.merge(df_lines, on=sales_filter + '_ID').merge(products, on='Product_ID')
-    df_all = df_all[['Product_name', 'Customer_ID', data_filter]]
-    df_all = df_all.groupby(['Customer_ID', 'Product_name'])[data_filter].sum().reset_index()
-    df = df_all.pivot(index='Customer_ID', columns='Product_name', values=data_filter).fillna(0.0)
+    df_all = sales_facts.groupby(['Customer_ID', mode + '_name'], observed=True)[data_filter].sum().reset_index()
+    df = df_all.pivot(index='Customer_ID', columns=mode + '_name', values=data_filter).fillna(0.0)
     df.columns = [str(col) for col in df.columns]
     normalized_df = pd.DataFrame(MinMaxScaler().fit_transform(df), columns=df.columns, index=df.index)
 
+    return normalized_df
+
+
+@st.cache_data
+def user_based_collaborative_filtering(sales_facts, customer_id, num_recommendations=3):
+    normalized_df = get_normalized_matrix(sales_facts, 'Product')
+
     random_customer_df = normalized_df[(normalized_df.index == customer_id)]
     mask = random_customer_df.iloc[0] > 0
     products_bought = mask.index[mask].tolist()
@@ -67,18 +71,8 @@ def user_based_collaborative_filtering(products, df_sales, df_lines, customer_id
 
 
 @st.cache_data
-def user_based_collaborative_filtering_for_category(products, categories, df_sales, df_lines, customer_id,
-                                                    num_recommendations=3):
-    data_filter = 'Quantity'
-    sales_filter = 'Invoice'
-
-    df_all = df_sales.merge(df_lines, on=sales_filter + '_ID').merge(products, on='Product_ID')
-    df_all = df_all.merge(categories, on='Category_ID')
-    df_all = df_all[['Category_name', 'Customer_ID', data_filter]]
-    df_all = df_all.groupby(['Customer_ID', 'Category_name'])[data_filter].sum().reset_index()
-    df = df_all.pivot(index='Customer_ID', columns='Category_name', values=data_filter).fillna(0.0)
-    df.columns = [str(col) for col in df.columns]
-    normalized_df = pd.DataFrame(MinMaxScaler().fit_transform(df), columns=df.columns, index=df.index)
+def user_based_collaborative_filtering_for_category(sales_facts, customer_id, num_recommendations=3):
+    normalized_df = get_normalized_matrix(sales_facts, 'Category')
 
     random_customer_df = normalized_df[(normalized_df.index == customer_id)]
     try:
@@ -120,16 +114,8 @@ def user_based_collaborative_filtering_for_category(products, categories, df_sal
 
 
 @st.cache_data
-def item_based_collaborative_filtering(products, df_sales, df_lines, product_name, num_recommendations=3):
-    data_filter = 'Quantity'
-    sales_filter = 'Invoice'
-
-    df_all = df_sales.merge(df_lines, on=sales_filter + '_ID').merge(products, on='Product_ID')
-    df_all = df_all[['Product_name', 'Customer_ID', data_filter]]
-    df_all = df_all.groupby(['Customer_ID', 'Product_name'])[data_filter].sum().reset_index()
-    df = df_all.pivot(index='Customer_ID', columns='Product_name', values=data_filter).fillna(0.0)
-    df.columns = [str(col) for col in df.columns]
-    normalized_df = pd.DataFrame(MinMaxScaler().fit_transform(df), columns=df.columns, index=df.index)
+def item_based_collaborative_filtering(sales_facts, product_name, num_recommendations=3):
+    normalized_df = get_normalized_matrix(sales_facts, 'Product')
 
     try:
         random_product_df = normalized_df[product_name]
@@ -143,18 +129,8 @@ def item_based_collaborative_filtering(products, df_sales, df_lines, product_nam
 
 
 @st.cache_data
-def item_based_collaborative_filtering_for_category(products, categories, df_sales, df_lines, category_name,
-                                                    num_recommendations=3):
-    data_filter = 'Quantity'
-    sales_filter = 'Invoice'
-
-    df_all = df_sales.merge(df_lines, on=sales_filter + '_ID').merge(products, on='Product_ID')
-    df_all = df_all.merge(categories, on='Category_ID')
-    df_all = df_all[['Category_name', 'Customer_ID', data_filter]]
-    df_all = df_all.groupby(['Customer_ID', 'Category_name'])[data_filter].sum().reset_index()
-    df = df_all.pivot(index='Customer_ID', columns='Category_name', values=data_filter).fillna(0.0)
-    df.columns = [str(col) for col in df.columns]
-    normalized_df = pd.DataFrame(MinMaxScaler().fit_transform(df), columns=df.columns, index=df.index)
+def item_based_collaborative_filtering_for_category(sales_facts, category_name, num_recommendations=3):
+    normalized_df = get_normalized_matrix(sales_facts, 'Category')
 
     try:
         random_category_df = normalized_df[category_name]
@@ -167,10 +143,10 @@ def item_based_collaborative_filtering_for_category(products, categories, df_sal
         return {'No recommendation available': None}
 
 
-def get_all_recommendations(customers, products, categories, df_sales, df_lines):
+def get_all_recommendations(customers, products, categories, sales_facts):
     ubcf_df = {}
     for customer_id in customers['Customer_ID']:
-        ubcf_df[customer_id] = user_based_collaborative_filtering(products, df_sales, df_lines, customer_id)
+        ubcf_df[customer_id] = user_based_collaborative_filtering(sales_facts, customer_id)
     recommendations_ubcf = pd.DataFrame(index=ubcf_df.keys(),
                                         columns=['Recommendation 1', 'Recommendation 2', 'Recommendation 3'])
     for customer in ubcf_df.keys():
@@ -184,9 +160,7 @@ def get_all_recommendations(customers, products, categories, df_sales, df_lines)
 
     ubcfc_df = {}
     for customer_id in customers['Customer_ID']:
-        ubcfc_df[customer_id] = user_based_collaborative_filtering_for_category(products, categories, df_sales,
-                                                                                df_lines,
-                                                                                customer_id)
+        ubcfc_df[customer_id] = user_based_collaborative_filtering_for_category(sales_facts, customer_id)
     recommendations_ubcfc = pd.DataFrame(index=ubcfc_df.keys(),
                                          columns=['Recommendation 1', 'Recommendation 2', 'Recommendation 3'])
     for customer in ubcfc_df.keys():
@@ -200,7 +174,7 @@ def get_all_recommendations(customers, products, categories, df_sales, df_lines)
 
     ibcf_df = {}
     for product_name in products['Product_name']:
-        ibcf_df[product_name] = item_based_collaborative_filtering(products, df_sales, df_lines, product_name)
+        ibcf_df[product_name] = item_based_collaborative_filtering(sales_facts, product_name)
     recommendations_ibcf = pd.DataFrame(index=ibcf_df.keys(),
                                         columns=['Recommendation 1', 'Recommendation 2', 'Recommendation 3'])
     for product in ibcf_df.keys():
@@ -214,8 +188,7 @@ def get_all_recommendations(customers, products, categories, df_sales, df_lines)
 
     ibcfc_df = {}
     for category_name in categories['Category_name']:
-        ibcfc_df[category_name] = item_based_collaborative_filtering_for_category(products, categories, df_sales,
-                                                                                  df_lines, category_name)
+        ibcfc_df[category_name] = item_based_collaborative_filtering_for_category(sales_facts, category_name)
     recommendations_ibcfc = pd.DataFrame(index=ibcfc_df.keys(),
                                          columns=['Recommendation 1', 'Recommendation 2', 'Recommendation 3'])
     for product in ibcfc_df.keys():
@@ -231,7 +204,7 @@ def get_all_recommendations(customers, products, categories, df_sales, df_lines)
 
 
 def next_prod_pred_main_function(apriori_rules_products, apriori_rules_categories, products, categories, customers,
-                                 df_sales, df_lines):
+                                 sales_facts):
     st.subheader('Associative Rule Learning')
     st.caption('Recommended products')
     product = st.selectbox('Choose a product', products['Product_name'])
@@ -249,13 +222,12 @@ def next_prod_pred_main_function(apriori_rules_products, apriori_rules_categorie
     customer_id = int(customer_id.split(' -- ')[0])
 
     st.caption('Recommended products')
-    recommended_products = user_based_collaborative_filtering(products, df_sales, df_lines, customer_id)
+    recommended_products = user_based_collaborative_filtering(sales_facts, customer_id)
     for product, score in recommended_products.items():
         st.markdown(f"- {product}")
 
     st.caption('Recommended categories')
-    recommended_categories = user_based_collaborative_filtering_for_category(products, categories, df_sales, df_lines,
-                                                                             customer_id)
+    recommended_categories = user_based_collaborative_filtering_for_category(sales_facts, customer_id)
     for category, score in recommended_categories.items():
         st.markdown(f"- {category}")
 
@@ -263,19 +235,18 @@ def next_prod_pred_main_function(apriori_rules_products, apriori_rules_categorie
 
     st.subheader('Collaborative Filtering - Item based')
     product = st.selectbox('Products',
-                           (products['Product_ID'].astype(str) + ' -- ' + products['Product_name']))
+                           (products['Product_ID'].astype(str) + ' -- ' + products['Product_name'].astype(str)))
     product_name = product.split(' -- ')[1]
     st.caption('Recommended products')
-    recommended_products = item_based_collaborative_filtering(products, df_sales, df_lines, product_name)
+    recommended_products = item_based_collaborative_filtering(sales_facts, product_name)
     for product, score in recommended_products.items():
         st.markdown(f"- {product}")
 
     category = st.selectbox('Categories',
-                            (categories['Category_ID'].astype(str) + ' -- ' + categories['Category_name']))
+                            (categories['Category_ID'].astype(str) + ' -- ' + categories['Category_name'].astype(str)))
     category_name = category.split(' -- ')[1]
     st.caption('Recommended categories')
-    recommended_categories = item_based_collaborative_filtering_for_category(products, categories, df_sales, df_lines,
-                                                                             category_name)
+    recommended_categories = item_based_collaborative_filtering_for_category(sales_facts, category_name)
     for category, score in recommended_categories.items():
         st.markdown(f"- {category}")
 
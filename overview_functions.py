@@ -3,7 +3,8 @@ import os
 import streamlit as st
 import plotly.graph_objects as go
 from utils.data_viz import show_timelines
-from utils.utility_functions import get_customer_location, get_cluster_location
+from utils.utility_functions import get_customer_location, get_cluster_location, get_address_store, \
+    get_customer_addresses
 
 
 @st.cache_data
@@ -18,7 +19,7 @@ def show_details(ml_clusters, segment_1_clusters, segment_2_clusters, product_gr
     return
 
 
-def customer_overview_function(address, overview_data, directory, snapshot_start_date, snapshot_end_date):
+def customer_overview_function(address_store, overview_data, directory, snapshot_start_date, snapshot_end_date):
     customer_id = st.selectbox('List of Customers',
                                (overview_data['Customer_ID'].astype(str) + ' - ' + overview_data['Customer_name']))
     customer_id = int(customer_id.split(' - ')[0])
@@ -44,12 +45,12 @@ def customer_overview_function(address, overview_data, directory, snapshot_start
 
     show_timelines(directory, snapshot_start_date, snapshot_end_date, customer_id)
 
-    get_customer_location(address, customer_id)
+    get_customer_location(get_customer_addresses(address_store, [customer_id]))
 
     return
 
 
-def cluster_overview_function(address, overview_data):
+def cluster_overview_function(address_store, overview_data):
     col1, col2 = st.columns(2)
     column_names = ['Cluster RFM', 'Segment 1', 'Segment 2', 'Product cluster MBA', 'Category cluster MBA']
     cluster_type = col1.selectbox('Cluster type', column_names)
@@ -86,7 +87,7 @@ def cluster_overview_function(address, overview_data):
         st.plotly_chart(fig)
 
     customer_ids = overview_data[overview_data[cluster_type] == cluster_id]['Customer_ID']
-    get_cluster_location(address, customer_ids)
+    get_cluster_location(get_customer_addresses(address_store, customer_ids))
 
     return
 
@@ -226,12 +227,13 @@ def freeze_and_send_data(overview_data, admin, ml_clusters, segment_1_clusters,
     return
 
 
-def overview_main_function(address, overview_data, ml_clusters, segment_1_clusters, segment_2_clusters,
+def overview_main_function(overview_data, ml_clusters, segment_1_clusters, segment_2_clusters,
                            product_grouped_df, category_grouped_df, product_recommendation, category_recommendation,
                            recommendations_ubcf, recommendations_ubcfc, recommendations_ibcf, recommendations_ibcfc,
                            directory, snapshot_start_date, snapshot_end_date, admin, sales_filter, customer_type):
     customer_overview_tab, cluster_overview_tab, data_tab = st.tabs(
         ['Customer overview', 'Cluster overview', 'Download data'])
+    address_store = get_address_store(customer_type, sales_filter, snapshot_start_date, snapshot_end_date, directory)
 
     with customer_overview_tab:
         st.subheader(f'Customer Overview', divider='grey')
@@ -239,7 +241,7 @@ def overview_main_function(address, overview_data, ml_clusters, segment_1_cluste
                 f'\n\nData type: :blue[{sales_filter}]' +
                 f'\n\nCustomer type: :blue[{customer_type}]' +
                 f'\n\nDate range: :blue[{snapshot_start_date}] to :blue[{snapshot_end_date}]', icon='ℹ️')
-        customer_overview_function(address, overview_data, directory, snapshot_start_date, snapshot_end_date)
+        customer_overview_function(address_store, overview_data, directory, snapshot_start_date, snapshot_end_date)
         show_details(ml_clusters, segment_1_clusters, segment_2_clusters, product_grouped_df, category_grouped_df)
 
     with cluster_overview_tab:
@@ -248,7 +250,7 @@ def overview_main_function(address, overview_data, ml_clusters, segment_1_cluste
                 f'\n\nData type: :blue[{sales_filter}]' +
                 f'\n\nCustomer type: :blue[{customer_type}]' +
                 f'\n\nDate range: :blue[{snapshot_start_date}] to :blue[{snapshot_end_date}]', icon='ℹ️')
-        cluster_overview_function(address, overview_data)
+        cluster_overview_function(address_store, overview_data)
         show_details(ml_clusters, segment_1_clusters, segment_2_clusters, product_grouped_df, category_grouped_df)
 
     with data_tab:
@@ -4,26 +4,20 @@ import umap.umap_ as umap
 import plotly.graph_objects as go
 import plotly.express as px
 from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
 from scipy.cluster.hierarchy import dendrogram, linkage
 from matplotlib import pyplot as plt
 from sklearn.cluster import AgglomerativeClustering
 from sklearn.preprocessing import MinMaxScaler
+from utils.utility_functions import select_cluster_score, compute_cluster_score, show_cluster_score
 
 
 @st.cache_data
-def clean_data(categories, products, df_sales, df_lines, data_filter, sales_filter):
-    df_sales.rename(columns={'Total_price': 'Final_price'}, inplace=True)
-    df = df_sales.merge(df_lines, on=sales_filter + '_ID').merge(products, on='Product_ID')
-    df = df[['Product_name', 'Customer_ID', data_filter]]
-    df = df.groupby(['Customer_ID', 'Product_name'])[data_filter].sum().reset_index()
+def clean_data(sales_facts, data_filter):
+    df = sales_facts.groupby(['Customer_ID', 'Product_name'], observed=True)[data_filter].sum().reset_index()
     df = df.pivot(index='Customer_ID', columns='Product_name', values=data_filter).fillna(0.0)
     df.columns = [str(col) for col in df.columns]
 
-    df_cat = df_sales.merge(df_lines, on=sales_filter + '_ID').merge(products, on='Product_ID').merge(
-        categories, on='Category_ID')
-    df_cat = df_cat[['Product_name', 'Category_name', 'Customer_ID', data_filter]]
-    df_cat = df_cat.groupby(['Customer_ID', 'Category_name'])[data_filter].sum().reset_index()
+    df_cat = sales_facts.groupby(['Customer_ID', 'Category_name'], observed=True)[data_filter].sum().reset_index()
     df_cat = df_cat.pivot(index='Customer_ID', columns='Category_name', values=data_filter).fillna(0.0)
     df_cat.columns = [str(col) for col in df_cat.columns]
 
@@ -75,11 +69,11 @@ def show_radar_plot(categorie_clusters):
 
 
 @st.cache_resource
-def kmeans_model(features, nb_clusters):
+def kmeans_model(features, nb_clusters, score_method):
     elbow_method(features)
     model = KMeans(n_clusters=nb_clusters, init='k-means++', n_init='auto')
     model.fit(features.values)
-    st.success('Silhouette score : ' + str(round(silhouette_score(features, model.labels_, metric='euclidean'), 2)))
+    show_cluster_score(*compute_cluster_score(features.values, model.labels_, score_method))
     predictions = model.predict(features)
     features['Cluster MBA'] = ['Cluster ' + str(pred) for pred in predictions]
     return features
@@ -108,9 +102,8 @@ def generate_umap(product_features):
     return umap_2d_data, umap_3d_data
 
 
-def prod_aff_main_function(df_sales, df_lines, categories, products, sales_filter, data_filter):
-    product_features, category_features = clean_data(categories, products, df_sales, df_lines, data_filter,
-                                                     sales_filter)
+def prod_aff_main_function(sales_facts, data_filter):
+    product_features, category_features = clean_data(sales_facts, data_filter)
     umap_2d_data, umap_3d_data = generate_umap(product_features)
 
     with st.expander('Product Clusters'):
@@ -118,7 +111,8 @@ def prod_aff_main_function(df_sales, df_lines, categories, products, sales_filte
                                       ['Kmeans', 'Agglomerative Clustering'])
         if product_model_name == 'Kmeans':
             nb_clusters_product = st.slider('Number of Product Clusters', 2, 11, 4)
-            product_clusters = kmeans_model(product_features, nb_clusters_product)
+            score_method = select_cluster_score('product_cluster_score')
+            product_clusters = kmeans_model(product_features, nb_clusters_product, score_method)
         else:
             nb_clusters_product = st.slider('How many Product Clusters do you want ?', 2, 11, 4)
             product_clusters = agglomerative_model(product_features, nb_clusters_product)
@@ -130,7 +124,8 @@ def prod_aff_main_function(df_sales, df_lines, categories, products, sales_filte
                                        ['Kmeans', 'Agglomerative Clustering'])
         if category_model_name == 'Kmeans':
             nb_clusters_category = st.slider('Number of Category Clusters', 2, 11, 4)
-            category_clusters = kmeans_model(category_features, nb_clusters_category)
+            score_method = select_cluster_score('category_cluster_score')
+            category_clusters = kmeans_model(category_features, nb_clusters_category, score_method)
         else:
             nb_clusters_category = st.slider('How many Category Clusters do you want ?', 2, 11, 4)
             category_clusters = agglomerative_model(category_features, nb_clusters_category)
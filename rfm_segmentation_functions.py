@@ -1,79 +1,233 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from scipy import stats
 import numpy as np
 import streamlit as st
 import plotly.express as px
 from plotly.subplots import make_subplots
-from sklearn.metrics import silhouette_score
 from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
+from threadpoolctl import threadpool_limits
 import plotly.graph_objects as go
 from sklearn.preprocessing import MinMaxScaler
-
-
-def compute_rfm_segments(df, snapshot_end_date, transformed_sales_filter):
+from utils.utility_functions import select_cluster_score, compute_cluster_score, show_cluster_score
+from utils.get_data import get_rfm_aggregates, get_rfm_history, share_frames, VIEW_CACHE_ENTRIES
+
+
+def get_segment_1_label(rfm_score):
+    if (rfm_score >= 111) & (rfm_score <= 155):
+        return 'Risky'
+
+    elif (rfm_score >= 211) & (rfm_score <= 255):
+        return 'Hold and improve'
+
+    elif (rfm_score >= 311) & (rfm_score <= 353):
+        return 'Potential loyal'
+
+    elif ((rfm_score >= 354) & (rfm_score <= 454)) or ((rfm_score >= 511) & (rfm_score <= 535)) or (
+            rfm_score == 541):
+        return 'Loyal'
+
+    elif (rfm_score == 455) or (rfm_score >= 542) & (rfm_score <= 555):
+        return 'Star'
+
+    else:
+        return 'Other'
+
+
+SEGMENT_2_MAP = {
+    r'[1-2][1-2]': 'Hibernating',
+    r'[1-2][3-4]': 'At risk',
+    r'[1-2]5': 'Can\'t loose',
+    r'3[1-2]': 'About to sleep',
+    r'33': 'Need attention',
+    r'[3-4][4-5]': 'Loyal customers',
+    r'41': 'Promising',
+    r'51': 'New customers',
+    r'[4-5][2-3]': 'Potential loyalists',
+    r'5[4-5]': 'Champions'
+}
+
+SEGMENT_1_COLORS = {
+    'Risky': '#29b09d',
+    'Hold and improve': '#ff2b2b',
+    'Potential loyal': '#904cd9',
+    'Loyal': '#0068c9',
+    'Star': '#ffd16a',
+    'Other': 'gray'
+}
+
+SEGMENT_2_COLORS = {
+    'Hibernating': '#83c9ff',
+    'At risk': '#29b09d',
+    'Can\'t loose': '#ff8700',
+    'About to sleep': '#7defa1',
+    'Need attention': '#757d79',
+    'Loyal customers': '#0068c9',
+    'Promising': '#ff2b2b',
+    'New customers': '#ffabab',
+    'Potential loyalists': '#904cd9',
+    'Champions': '#ffd16a'
+}
+
+# Above this number of customers, the RFM plots are aggregated server-side instead of sending one point per customer
+RFM_POINT_BUDGET = int(os.environ.get('RFM_POINT_BUDGET', 20000))
+RFM_VOXELS = 20
+
+SNAPSHOT_FREQUENCIES = {'Monthly': pd.offsets.MonthEnd(), 'Quarterly': pd.offsets.QuarterEnd()}
+
+# Labels of both segmentations for every (R, F, M) score, indexed by the scores minus one
+SCORES = np.arange(1, 6)
+SEGMENT_1_LABELS = np.array([[[get_segment_1_label(100 * r + 10 * f + m) for m in SCORES] for f in SCORES]
+                             for r in SCORES], dtype=object)
+SEGMENT_2_LABELS = np.repeat(
+    pd.Series([str(r) + str(f) for r in SCORES for f in SCORES]).replace(SEGMENT_2_MAP, regex=True)
+    .to_numpy(dtype=object).reshape(5, 5, 1), 5, axis=2)
+
+
+def compute_rfm_segments(rfm_aggregates, snapshot_end_date):
     snapshot_end_date = pd.to_datetime(snapshot_end_date)
 
-    rfm = df.groupby('Customer_ID').agg(
-        {transformed_sales_filter + '_date': lambda x: (snapshot_end_date - x.max()).days,
-         transformed_sales_filter + '_ID': lambda x: len(x),
-         'Total_price': lambda x: x.sum()}).reset_index()
-
-    rfm[transformed_sales_filter + '_date'] = rfm[transformed_sales_filter + '_date'].astype(int)
-
-    rfm.rename(columns={transformed_sales_filter + '_date': 'Recency',
-                        transformed_sales_filter + '_ID': 'Frequency',
-                        'Total_price': 'Monetary'}, inplace=True)
-    quintiles = rfm[['Recency', 'Frequency', 'Monetary']].quantile([.2, .4, .6, .8]).to_dict()
-
-    def r_score(x):
-        if x <= quintiles['Recency'][.2]:
-            return 5
-        elif x <= quintiles['Recency'][.4]:
-            return 4
-        elif x <= quintiles['Recency'][.6]:
-            return 3
-        elif x <= quintiles['Recency'][.8]:
-            return 2
-        else:
-            return 1
-
-    def fm_score(x, c):
-        if x <= quintiles[c][.2]:
-            return 1
-        elif x <= quintiles[c][.4]:
-            return 2
-        elif x <= quintiles[c][.6]:
-            return 3
-        elif x <= quintiles[c][.8]:
-            return 4
-        else:
-            return 5
+    rfm = pd.DataFrame({
+        'Customer_ID': rfm_aggregates['Customer_ID'],
+        'Recency': (snapshot_end_date - rfm_aggregates['Last_sale_date']).dt.days.astype(int),
+        'Frequency': rfm_aggregates['Sale_count'],
+        'Monetary': rfm_aggregates['Sale_total'],
+    })
+    quintiles = rfm[['Recency', 'Frequency', 'Monetary']].quantile([.2, .4, .6, .8])
 
-    rfm['R'] = rfm['Recency'].apply(lambda x: r_score(x))
-    rfm['F'] = rfm['Frequency'].apply(lambda x: fm_score(x, 'Frequency'))
-    rfm['M'] = rfm['Monetary'].apply(lambda x: fm_score(x, 'Monetary'))
+    # Number of quintiles strictly below each value: 0 up to the first quintile included, 4 above the last one
+    rfm['R'] = 5 - np.searchsorted(quintiles['Recency'].to_numpy(), rfm['Recency'].to_numpy(), side='left')
+    rfm['F'] = 1 + np.searchsorted(quintiles['Frequency'].to_numpy(), rfm['Frequency'].to_numpy(), side='left')
+    rfm['M'] = 1 + np.searchsorted(quintiles['Monetary'].to_numpy(), rfm['Monetary'].to_numpy(), side='left')
 
     return rfm
 
 
+def label_rfm_segments(rfm):
+    r, f, m = rfm['R'].to_numpy() - 1, rfm['F'].to_numpy() - 1, rfm['M'].to_numpy() - 1
+    return rfm.assign(**{'Segment 1': SEGMENT_1_LABELS[r, f, m], 'Segment 2': SEGMENT_2_LABELS[r, f, m]})
+
+
+def compute_rfm_cube(rfm):
+    # Number of customers of every (R, F, M) cell, indexed like the segment labels
+    cells = ((rfm['R'].to_numpy() - 1) * 5 + rfm['F'].to_numpy() - 1) * 5 + rfm['M'].to_numpy() - 1
+    return np.bincount(cells, minlength=125).reshape(5, 5, 5)
+
+
+def count_segments(rfm_cube, labels):
+    segments_counts = pd.Series(rfm_cube.ravel()).groupby(labels.ravel()).sum()
+    return segments_counts[segments_counts > 0].sort_values(ascending=False)
+
+
+@st.cache_resource(max_entries=VIEW_CACHE_ENTRIES)
+def get_rfm_segments(customer_type, sales_filter, snapshot_start_date, snapshot_end_date, directory):
+    rfm_aggregates = get_rfm_aggregates(customer_type, sales_filter, snapshot_start_date, snapshot_end_date,
+                                        directory, True, True)
+    rfm = label_rfm_segments(compute_rfm_segments(rfm_aggregates, snapshot_end_date))
+    return rfm, compute_rfm_cube(rfm)
+
+
+def get_snapshot_dates(snapshot_start_date, snapshot_end_date, frequency):
+    snapshot_dates = [date.date() for date in pd.date_range(snapshot_start_date, snapshot_end_date,
+                                                            freq=SNAPSHOT_FREQUENCIES[frequency])]
+    if not snapshot_dates or snapshot_dates[-1] != snapshot_end_date:
+        snapshot_dates.append(snapshot_end_date)
+    return snapshot_dates
+
+
+def compute_rfm_trajectories(rfm_history):
+    # Quintiles are computed within each snapshot, exactly like a single RFM segmentation ending on that date
+    trajectories = [compute_rfm_segments(snapshot, snapshot_date).assign(Snapshot_date=snapshot_date)
+                    for snapshot_date, snapshot in rfm_history.groupby('Snapshot_date')]
+    return label_rfm_segments(pd.concat(trajectories, ignore_index=True))
+
+
+@st.cache_resource(max_entries=VIEW_CACHE_ENTRIES)
+def get_rfm_trajectories(customer_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, frequency):
+    snapshot_dates = get_snapshot_dates(snapshot_start_date, snapshot_end_date, frequency)
+    rfm_history = get_rfm_history(customer_type, sales_filter, snapshot_start_date, snapshot_dates, directory, True)
+    return compute_rfm_trajectories(rfm_history)
+
+
+def compute_segment_transitions(trajectories, segment):
+    # Segment of every customer at every snapshot as codes, customers without any purchase yet getting their own
+    segment_codes, segments = pd.factorize(trajectories[segment], sort=True)
+    segments = np.append(segments, 'No purchase')
+    customer_codes, customer_ids = pd.factorize(trajectories['Customer_ID'])
+    snapshot_dates, snapshot_codes = np.unique(trajectories['Snapshot_date'].to_numpy(), return_inverse=True)
+    labels = np.full((len(customer_ids), len(snapshot_dates)), len(segments) - 1)
+    labels[customer_codes, snapshot_codes] = segment_codes
+
+    transitions = []
+    for snapshot in range(len(snapshot_dates) - 1):
+        counts = np.bincount(labels[:, snapshot] * len(segments) + labels[:, snapshot + 1],
+                             minlength=len(segments) ** 2)
+        pairs = np.flatnonzero(counts)
+        transitions.append(pd.DataFrame({
+            'From_date': snapshot_dates[snapshot], 'To_date': snapshot_dates[snapshot + 1],
+            'From': segments[pairs // len(segments)], 'To': segments[pairs % len(segments)],
+            'Customers': counts[pairs]}))
+    if not transitions:
+        return pd.DataFrame(columns=['From_date', 'To_date', 'From', 'To', 'Customers'])
+    return pd.concat(transitions, ignore_index=True)
+
+
+def compute_box_statistics(values):
+    # Same quartiles and whiskers as plotly, the outliers being left out
+    values = np.sort(values)
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    whiskers = values[(values >= q1 - 1.5 * (q3 - q1)) & (values <= q3 + 1.5 * (q3 - q1))]
+    return dict(q1=[q1], median=[median], q3=[q3], lowerfence=[whiskers[0]], upperfence=[whiskers[-1]],
+                mean=[values.mean()])
+
+
 def show_rfm_distribution(rfm):
     fig = make_subplots(rows=3, cols=1, subplot_titles=('Recency', 'Frequency', 'Monetary'))
+    aggregated = len(rfm) > RFM_POINT_BUDGET
     for i, j in enumerate(['Recency', 'Frequency', 'Monetary']):
-        fig.add_box(x=rfm[str(j)], row=i + 1, col=1, name=str(j))
+        if aggregated:
+            fig.add_trace(go.Box(name=str(j), orientation='h', y=[str(j)],
+                                 **compute_box_statistics(rfm[str(j)].to_numpy())), row=i + 1, col=1)
+        else:
+            fig.add_box(x=rfm[str(j)], row=i + 1, col=1, name=str(j))
     fig.update_layout(bargap=0.2, title='Boxplot for RFM Values')
     st.write(fig)
+    if aggregated:
+        st.caption(f'Boxes computed over {len(rfm)} customers: the outliers are not drawn.')
 
     return fig
 
 
+def compute_rfm_voxels(rfm, nb_voxels=RFM_VOXELS):
+    # Customers binned on a regular grid, each voxel drawn at the mean position of its customers
+    values = rfm[['Recency', 'Frequency', 'Monetary']].to_numpy(dtype=float)
+    low, high = values.min(axis=0), values.max(axis=0)
+    bins = np.floor((values - low) / np.where(high > low, high - low, 1) * nb_voxels).clip(0, nb_voxels - 1)
+    voxels = pd.DataFrame(values, columns=['Recency', 'Frequency', 'Monetary'])
+    voxels['Voxel'] = (bins[:, 0] * nb_voxels + bins[:, 1]) * nb_voxels + bins[:, 2]
+    voxels = voxels.groupby('Voxel').agg(Recency=('Recency', 'mean'), Frequency=('Frequency', 'mean'),
+                                         Monetary=('Monetary', 'mean'), Customers=('Monetary', 'size'))
+    return voxels.reset_index(drop=True)
+
+
 def show_rfm_scatter_3d(rfm):
-    fig = px.scatter_3d(rfm, x='Recency', y='Frequency', z='Monetary', color='Monetary')
+    if len(rfm) > RFM_POINT_BUDGET:
+        voxels = compute_rfm_voxels(rfm)
+        fig = px.scatter_3d(voxels, x='Recency', y='Frequency', z='Monetary', color='Monetary', size='Customers',
+                            hover_data=['Customers'], size_max=30)
+    else:
+        fig = px.scatter_3d(rfm, x='Recency', y='Frequency', z='Monetary', color='Monetary')
     fig.update_layout(scene=dict(
         xaxis_title='Recency',
         yaxis_title='Frequency',
         zaxis_title='Monetary'), title='3D scatter of RFM Values')
     st.write(fig)
+    if len(rfm) > RFM_POINT_BUDGET:
+        st.caption(f'{len(rfm)} customers aggregated into {len(voxels)} voxels of a '
+                   f'{RFM_VOXELS}x{RFM_VOXELS}x{RFM_VOXELS} grid.')
 
     return fig
 
@@ -95,27 +249,49 @@ def clean_data(rfm):
     return scaled_features, scaler
 
 
-def elbow_method(scaled_features):
-    SSE = []
-    for cluster in range(1, 12):
-        kmeans = KMeans(n_clusters=cluster, init='k-means++', n_init='auto')
-        kmeans.fit(scaled_features.values)
-        SSE.append(kmeans.inertia_)
+def get_features_fingerprint(scaled_features):
+    return hashlib.sha1(np.ascontiguousarray(scaled_features.values).tobytes()).hexdigest()
+
+
+def fit_kmeans(features, nb_clusters):
+    kmeans = KMeans(n_clusters=nb_clusters, init='k-means++', n_init='auto')
+    kmeans.fit(features)
+    return kmeans
+
+
+@st.cache_resource(max_entries=VIEW_CACHE_ENTRIES)
+def fit_kmeans_sweep(fingerprint, _scaled_features):
+    # Cached on the fingerprint of the features: moving the slider only picks one of the fitted models. The models are
+    # fitted side by side, each thread limited to its share of the OpenMP threads of KMeans (a per-thread setting)
+    nb_cores = os.cpu_count() or 1
+    workers = min(12, nb_cores)
+    threads = max(1, nb_cores // workers)
+    with ThreadPoolExecutor(workers, initializer=lambda: threadpool_limits(threads, user_api='openmp')) as executor:
+        models = list(executor.map(lambda nb_clusters: fit_kmeans(_scaled_features.values, nb_clusters),
+                                   range(1, 13)))
+    models = dict(zip(range(1, 13), models))
+    scores = pd.DataFrame({'Cluster': list(models), 'SSE': [kmeans.inertia_ for kmeans in models.values()]})
+    return models, scores
+
 
-    frame = pd.DataFrame({'Cluster': range(1, 12), 'SSE': SSE})
-    fig = px.line(x=frame['Cluster'], y=frame['SSE'])
+@st.cache_data
+def get_cluster_score(fingerprint, nb_clusters, method, _scaled_features, _kmeans):
+    # Only computed for the selected models, the exact silhouette being quadratic in the number of customers
+    return compute_cluster_score(_scaled_features.values, _kmeans.labels_, method)
+
+
+def elbow_method(scores):
+    fig = px.line(x=scores['Cluster'], y=scores['SSE'])
     st.write(fig)
     return fig
 
 
-def customer_segmentation_model(scaled_features, nb_clusters):
-    kmeans = KMeans(n_clusters=nb_clusters, init='k-means++', n_init='auto')
+def customer_segmentation_model(models, fingerprint, scaled_features, nb_clusters, score_method):
+    kmeans = models[nb_clusters]
     scaled_features = pd.DataFrame(scaled_features, columns=['Recency', 'Frequency', 'Monetary'])
-    kmeans.fit(scaled_features.values)
-    st.success(
-        'Silhouette score : ' + str(round(silhouette_score(scaled_features, kmeans.labels_, metric='euclidean'), 2)))
+    show_cluster_score(*get_cluster_score(fingerprint, nb_clusters, score_method, scaled_features, kmeans))
 
-    pred = kmeans.predict(scaled_features)
+    pred = kmeans.predict(scaled_features.values)
     scaled_features['Cluster RFM'] = ['Cluster ' + str(i) for i in pred]
 
     avg_df = scaled_features.groupby(['Cluster RFM'], as_index=False).mean()
@@ -126,6 +302,13 @@ def customer_segmentation_model(scaled_features, nb_clusters):
     return kmeans, avg_df, scaled_features
 
 
+def assign_rfm_clusters(rfm, scaler, kmeans):
+    # Works for any customers, including ones the model was not fitted on
+    features = scaler.transform(rfm[['Recency', 'Frequency', 'Monetary']].values)
+    clusters = kmeans.predict(features)
+    return 'Cluster ' + pd.Series(clusters, index=rfm.index).astype(str)
+
+
 def show_rfm_clusters(avg_df, scaled_features):
     fig = go.Figure()
     for i in range(len(avg_df['Cluster RFM'])):
@@ -145,48 +328,16 @@ def show_rfm_clusters(avg_df, scaled_features):
     return fig
 
 
-def show_customer_segment_distribution(rfm):
+def show_customer_segment_distribution(rfm_cube):
     st.info('This RFM Segmentation is based on this PhD thesis (2021): '
             'https://dergipark.org.tr/tr/download/article-file/2343280', icon='ℹ️')
 
-    rfm['RFM score'] = rfm['R'].map(str) + rfm['F'].map(str) + rfm['M'].map(str)
-    rfm['RFM_count'] = rfm.groupby(['R', 'F', 'M'])['R'].transform('count')
-
-    def label_rfm_segments(rfm_score):
-        rfm_score = int(rfm_score)
-        if (rfm_score >= 111) & (rfm_score <= 155):
-            return 'Risky'
-
-        elif (rfm_score >= 211) & (rfm_score <= 255):
-            return 'Hold and improve'
-
-        elif (rfm_score >= 311) & (rfm_score <= 353):
-            return 'Potential loyal'
-
-        elif ((rfm_score >= 354) & (rfm_score <= 454)) or ((rfm_score >= 511) & (rfm_score <= 535)) or (
-                rfm_score == 541):
-            return 'Loyal'
-
-        elif (rfm_score == 455) or (rfm_score >= 542) & (rfm_score <= 555):
-            return 'Star'
-
-        else:
-            return 'Other'
-
-    rfm['Segment 1'] = rfm.apply(lambda x: label_rfm_segments(x['RFM score']), axis=1)
-    rfm['size'] = np.ceil(rfm['RFM_count'] / 10) * 10
-
-    colors_palette = {
-        'Risky': '#29b09d',
-        'Hold and improve': '#ff2b2b',
-        'Potential loyal': '#904cd9',
-        'Loyal': '#0068c9',
-        'Star': '#ffd16a',
-        'Other': 'gray'
-    }
-
-    fig_scatter = px.scatter_3d(rfm, x='R', y='F', z='M', color='Segment 1', size='RFM_count',
-                                color_discrete_map=colors_palette, opacity=1, size_max=40)
+    # Customers of a same (R, F, M) cell share the point and the label: one point per cell is drawn
+    r, f, m = np.nonzero(rfm_cube)
+    cells = pd.DataFrame({'R': r + 1, 'F': f + 1, 'M': m + 1, 'RFM_count': rfm_cube[r, f, m],
+                          'Segment 1': SEGMENT_1_LABELS[r, f, m]})
+    fig_scatter = px.scatter_3d(cells, x='R', y='F', z='M', color='Segment 1', size='RFM_count',
+                                color_discrete_map=SEGMENT_1_COLORS, opacity=1, size_max=40)
 
     fig_scatter.update_layout(scene=dict(
         xaxis_title='Recency',
@@ -194,16 +345,16 @@ def show_customer_segment_distribution(rfm):
         zaxis_title='Monetary'), title='3D scatter of RFM Segments')
     st.write(fig_scatter)
 
-    segments_counts = rfm['Segment 1'].value_counts().sort_values(ascending=False)
+    segments_counts = count_segments(rfm_cube, SEGMENT_1_LABELS)
     fig_pie = px.pie(segments_counts, values=segments_counts.values, names=segments_counts.index,
-                     color=segments_counts.index, color_discrete_map=colors_palette)
+                     color=segments_counts.index, color_discrete_map=SEGMENT_1_COLORS)
     fig_pie.update_layout(title='Proportion of RFM Segments')
     st.write(fig_pie)
 
     return fig_scatter, fig_pie
 
 
-def show_customer_segment_distribution_rfm(rfm):
+def show_customer_segment_distribution_rfm(rfm_cube):
     legend = [
         ('#83c9ff', 'Hibernating'), ('#29b09d', 'At risk'), ('#ff8700', 'Can\'t lose them'),
         ('#7defa1', 'About to sleep'), ('#757d79', 'Need attention'), ('#0068c9', 'Loyal customers'),
@@ -229,10 +380,10 @@ def show_customer_segment_distribution_rfm(rfm):
 
     for f in range(5):
         for r in range(5):
-            filtered_data = rfm[(rfm['R'] == r + 1) & (rfm['F'] == f + 1)]['M']
-            if not filtered_data.empty:
-                y = filtered_data.value_counts().sort_index()
-                x = y.index
+            x = np.flatnonzero(rfm_cube[r, f])
+            if len(x):
+                y = rfm_cube[r, f, x]
+                x = x + 1
                 color = None
                 for c, coords in color_mapping.items():
                     if (f, r) in coords:
@@ -247,43 +398,14 @@ def show_customer_segment_distribution_rfm(rfm):
     fig_treemap.update_layout(title="RFM Treemap")
     st.write(fig_treemap)
 
-    colors = {
-        'Hibernating': '#83c9ff',
-        'At risk': '#29b09d',
-        'Can\'t loose': '#ff8700',
-        'About to sleep': '#7defa1',
-        'Need attention': '#757d79',
-        'Loyal customers': '#0068c9',
-        'Promising': '#ff2b2b',
-        'New customers': '#ffabab',
-        'Potential loyalists': '#904cd9',
-        'Champions': '#ffd16a'
-    }
-
-    segt_map = {
-        r'[1-2][1-2]': 'Hibernating',
-        r'[1-2][3-4]': 'At risk',
-        r'[1-2]5': 'Can\'t loose',
-        r'3[1-2]': 'About to sleep',
-        r'33': 'Need attention',
-        r'[3-4][4-5]': 'Loyal customers',
-        r'41': 'Promising',
-        r'51': 'New customers',
-        r'[4-5][2-3]': 'Potential loyalists',
-        r'5[4-5]': 'Champions'
-    }
-
-    rfm['Segment 2'] = rfm['R'].map(str) + rfm['F'].map(str)
-    rfm['Segment 2'] = rfm['Segment 2'].replace(segt_map, regex=True)
-
-    segments_counts = rfm['Segment 2'].value_counts().sort_values(ascending=False)
+    segments_counts = count_segments(rfm_cube, SEGMENT_2_LABELS)
 
     fig_pie = px.pie(
         segments_counts,
         values=segments_counts.values,
         names=segments_counts.index,
         color=segments_counts.index,
-        color_discrete_map=colors
+        color_discrete_map=SEGMENT_2_COLORS
     )
     fig_pie.update_layout(title='Proportion of RFM Segments')
     st.write(fig_pie)
@@ -291,6 +413,36 @@ def show_customer_segment_distribution_rfm(rfm):
     return fig_treemap, fig_pie
 
 
+def show_segment_sankey(transitions, colors):
+    transitions = transitions[(transitions['From'] != 'No purchase') | (transitions['To'] != 'No purchase')]
+    nodes = pd.concat([
+        transitions[['From_date', 'From']].set_axis(['Snapshot_date', 'Segment'], axis=1),
+        transitions[['To_date', 'To']].set_axis(['Snapshot_date', 'Segment'], axis=1)]).drop_duplicates()
+    nodes = nodes.sort_values(['Snapshot_date', 'Segment'], ignore_index=True)
+    node_ids = pd.MultiIndex.from_frame(nodes)
+
+    fig = go.Figure(go.Sankey(
+        node=dict(label=nodes['Segment'], color=nodes['Segment'].map(colors).fillna('lightgray'),
+                  customdata=nodes['Snapshot_date'].dt.strftime('%d/%m/%Y'),
+                  hovertemplate='%{label} on %{customdata}: %{value} customers<extra></extra>'),
+        link=dict(source=node_ids.get_indexer(pd.MultiIndex.from_frame(transitions[['From_date', 'From']])),
+                  target=node_ids.get_indexer(pd.MultiIndex.from_frame(transitions[['To_date', 'To']])),
+                  value=transitions['Customers'])))
+    fig.update_layout(title='Customer flows between RFM segments')
+    st.write(fig)
+    return fig
+
+
+def show_transition_matrix(transitions, to_date):
+    transitions = transitions[transitions['To_date'] == pd.to_datetime(to_date, format='%d/%m/%Y')]
+    matrix = transitions.pivot_table(index='From', columns='To', values='Customers', aggfunc='sum', fill_value=0)
+    fig = px.imshow(matrix, text_auto=True, color_continuous_scale='Blues', aspect='auto')
+    from_date = transitions['From_date'].iloc[0].strftime('%d/%m/%Y')
+    fig.update_layout(title='Transitions from ' + from_date + ' to ' + to_date, xaxis_title='To', yaxis_title='From')
+    st.write(fig)
+    return fig
+
+
 def segment_1_details(df):
     data = [['Star',
              'It is the customer group that makes purchases most frequently, most up-to-date and in the highest amounts. It is the customer group with the highest score in terms of purchase frequency and currency, and purchase amounts'],
@@ -347,11 +499,13 @@ def segment_2_details(df):
     return data
 
 
-def rfm_main_function(df, snapshot_end_date, customers, directory, snapshot_start_date, sales_filter, customer_type):
-    rfm = compute_rfm_segments(df, snapshot_end_date, sales_filter)
+def rfm_main_function(snapshot_end_date, customers, directory, snapshot_start_date, sales_filter, customer_type):
+    rfm, rfm_cube = get_rfm_segments(customer_type, sales_filter, snapshot_start_date, snapshot_end_date, directory)
+    rfm = share_frames(rfm)
 
-    col1, col2, col3, col4 = st.tabs(
-        ['RFM Distribution', 'Customer Clusters using ML', 'Customer Segments using RFM scores', 'Download data'])
+    col1, col2, col3, col4, col5 = st.tabs(
+        ['RFM Distribution', 'Customer Clusters using ML', 'Customer Segments using RFM scores',
+         'Segment trajectories', 'Download data'])
 
     with col1:
         st.subheader(f'Recency, Frequency, Monetary Distribution', divider='grey')
@@ -368,9 +522,13 @@ def rfm_main_function(df, snapshot_end_date, customers, directory, snapshot_star
                 f'\n\nData type: :blue[{sales_filter}]' +
                 f'\n\nCustomer type: :blue[{customer_type}]' +
                 f'\n\nDate range: :blue[{snapshot_start_date}] to :blue[{snapshot_end_date}]', icon='ℹ️')
-        elbow_method(scaled_features)
+        fingerprint = get_features_fingerprint(scaled_features)
+        models, scores = fit_kmeans_sweep(fingerprint, scaled_features)
+        elbow_method(scores)
         nb_clusters = st.slider('Number of Clusters', 2, 12, 4)
-        kmeans, average_clusters, scaled_features = customer_segmentation_model(scaled_features, nb_clusters)
+        score_method = select_cluster_score('rfm_cluster_score')
+        kmeans, average_clusters, scaled_features = customer_segmentation_model(models, fingerprint, scaled_features,
+                                                                                nb_clusters, score_method)
         st.subheader(f'Results: RFM Clusters', divider='grey')
         st.info(f'Company: :blue[{directory}]' +
                 f'\n\nData type: :blue[{sales_filter}]' +
@@ -383,22 +541,33 @@ def rfm_main_function(df, snapshot_end_date, customers, directory, snapshot_star
                 f'\n\nData type: :blue[{sales_filter}]' +
                 f'\n\nCustomer type: :blue[{customer_type}]' +
                 f'\n\nDate range: :blue[{snapshot_start_date}] to :blue[{snapshot_end_date}]', icon='ℹ️')
-        show_customer_segment_distribution(rfm)
+        show_customer_segment_distribution(rfm_cube)
         st.subheader(f'Customer Segment Distribution - Second approach', divider='grey')
         st.info(f'Company: :blue[{directory}]' +
                 f'\n\nData type: :blue[{sales_filter}]' +
                 f'\n\nCustomer type: :blue[{customer_type}]' +
                 f'\n\nDate range: :blue[{snapshot_start_date}] to :blue[{snapshot_end_date}]', icon='ℹ️')
-        show_customer_segment_distribution_rfm(rfm)
+        show_customer_segment_distribution_rfm(rfm_cube)
     with col4:
-        col_names = ['Recency', 'Frequency', 'Monetary']
-        customer_cluster_list = []
-        for customer_id in rfm['Customer_ID']:
-            features = rfm[rfm['Customer_ID'] == customer_id][col_names]
-            scaled_features = scaler.transform(features.values)
-            customer_cluster = kmeans.predict(scaled_features)
-            customer_cluster_list.append('Cluster ' + str(customer_cluster[0]))
-        rfm['Cluster RFM'] = customer_cluster_list
+        st.subheader(f'Customer Segment Trajectories', divider='grey')
+        st.info(f'Company: :blue[{directory}]' +
+                f'\n\nData type: :blue[{sales_filter}]' +
+                f'\n\nCustomer type: :blue[{customer_type}]' +
+                f'\n\nDate range: :blue[{snapshot_start_date}] to :blue[{snapshot_end_date}]', icon='ℹ️')
+        frequency = st.radio('Snapshot frequency', list(SNAPSHOT_FREQUENCIES), index=1, horizontal=True)
+        segment = st.radio('Segmentation', ['Segment 1', 'Segment 2'], horizontal=True)
+        trajectories = get_rfm_trajectories(customer_type, sales_filter, snapshot_start_date, snapshot_end_date,
+                                            directory, frequency)
+        transitions = compute_segment_transitions(trajectories, segment)
+        if transitions.empty:
+            st.warning('The date range holds a single snapshot: there is no transition to show.')
+        else:
+            show_segment_sankey(transitions, SEGMENT_1_COLORS if segment == 'Segment 1' else SEGMENT_2_COLORS)
+            to_date = st.selectbox('Transitions up to',
+                                   list(transitions['To_date'].drop_duplicates().dt.strftime('%d/%m/%Y')))
+            show_transition_matrix(transitions, to_date)
+    with col5:
+        rfm['Cluster RFM'] = assign_rfm_clusters(rfm, scaler, kmeans)
         rfm = rfm.merge(customers[['Customer_ID', 'Customer_name']], on='Customer_ID')
         rfm['Customer_ID'] = rfm['Customer_ID'].astype(int)
         st.subheader(f'Details for all customers', divider='grey')
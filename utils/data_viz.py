@@ -3,6 +3,7 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+from utils.get_data import get_sales_headers
 
 
 @st.cache_data
@@ -23,18 +24,19 @@ def show_plots(invoices, orders):
     st.write(fig_2)
 
     data = orders['Status'].value_counts()
+    data = data[data > 0]
     fig_3 = px.bar(data, y=data.values, x=data.index,
                    title='Proportion of Orders status')
     fig_3.update_layout(yaxis_title='Count')
     st.write(fig_3)
 
-    invoices['Paid'] = invoices['Paid'].replace({0: 'Unpaid', 1: 'Paid'})
-    data = invoices['Paid'].value_counts()
+    data = invoices['Paid'].replace({0: 'Unpaid', 1: 'Paid'}).value_counts()
     fig_4 = px.pie(data, values=data.values, names=data.index,
                    title='Proportion of Paid Invoices')
     st.write(fig_4)
 
     data = invoices['Invoice_type'].value_counts()
+    data = data[data > 0]
     fig_5 = px.pie(data, values=data.values, names=data.index,
                    title='Proportion of Invoice types')
     st.write(fig_5)
@@ -44,16 +46,14 @@ def show_plots(invoices, orders):
 
 @st.cache_data
 def show_timelines(directory, snapshot_start_date, snapshot_end_date, customer_id=None):
-    path = './data/' + directory
-    invoices = pd.read_csv(f'{path}/Invoices.csv')
-    orders = pd.read_csv(f'{path}/Orders.csv')
+    invoices, orders = get_sales_headers(directory)
 
     if customer_id:
         invoices = invoices[(invoices['Customer_ID'] == customer_id)]
         orders = orders[(orders['Customer_ID'] == customer_id)]
 
-    invoices['Invoice_date'] = pd.to_datetime(invoices['Invoice_date']).dt.normalize()
-    orders['Order_date'] = pd.to_datetime(orders['Order_date']).dt.normalize()
+    invoices = invoices.assign(Invoice_date=pd.to_datetime(invoices['Invoice_date']).dt.normalize())
+    orders = orders.assign(Order_date=pd.to_datetime(orders['Order_date']).dt.normalize())
 
     min_date = min(invoices['Invoice_date'].min(), orders['Order_date'].min())
     max_date = max(invoices['Invoice_date'].max(), orders['Order_date'].max())
@@ -1,35 +1,306 @@
+import os
+import re
+import json
+import hashlib
 import datetime
+import numpy as np
 import pandas as pd
 import streamlit as st
+from sqlalchemy import create_engine, text
 
+CACHE_FOLDER = '.cache'
+CACHE_VERSION = 2
 
-@st.cache_data
+SQL_CHUNK_SIZE = 100000
+LINES_CHUNK_SIZE = 1000000
+
+# Line tables bigger than this are never loaded whole: the dashboard falls back to per-customer aggregates
+MAX_LINES_FILE_SIZE = int(os.environ.get('MAX_LINES_FILE_MB', 2048)) * 2 ** 20
+# Filter combinations kept by each per-view cache, the per-company stores being kept for the life of the process
+VIEW_CACHE_ENTRIES = int(os.environ.get('VIEW_CACHE_ENTRIES', 32))
+
+TABLES = ['Addresses', 'Categories', 'Customers', 'Invoices', 'Invoice_lines', 'Orders', 'Order_lines', 'Products']
+LINE_TABLES = ['Invoice_lines', 'Order_lines']
+
+# Keys are int32, repeated labels categorical and dates parsed at read time
+TABLE_SCHEMAS = {
+    'Addresses': {
+        'dtype': {'Address_ID': 'int32', 'Customer_ID': 'int32', 'Address_1': str, 'Address_2': str,
+                  'Zip_code': str, 'City': 'category', 'Country': 'category', 'Address_type': 'category'},
+    },
+    'Categories': {
+        'dtype': {'Category_ID': 'int32', 'Category_name': 'category'},
+    },
+    'Customers': {
+        'dtype': {'Customer_ID': 'int32', 'Customer_name': str, 'Customer_type': 'category'},
+    },
+    'Invoices': {
+        'dtype': {'Invoice_ID': 'int32', 'Customer_ID': 'int32', 'Invoice_address_ID': 'int32',
+                  'Invoice_type': 'category'},
+        'parse_dates': ['Invoice_date'],
+    },
+    'Invoice_lines': {
+        'dtype': {'Invoice_ID': 'int32', 'Product_ID': 'int32'},
+    },
+    'Orders': {
+        'dtype': {'Order_ID': 'int32', 'Customer_ID': 'int32', 'Status': 'category'},
+        'parse_dates': ['Order_date'],
+    },
+    'Order_lines': {
+        'dtype': {'Order_ID': 'int32', 'Product_ID': 'int32'},
+    },
+    'Products': {
+        'dtype': {'Product_ID': 'int32', 'Product_name': 'category', 'Category_ID': 'int32'},
+    },
+}
+
+
+def get_file_signature(file_path):
+    file_stat = os.stat(file_path)
+    return {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns}
+
+
+def get_file_hash(file_path, chunk_size=2 ** 20):
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def read_cache_manifest(manifest_path, cache_path):
+    if not (os.path.exists(manifest_path) and os.path.exists(cache_path)):
+        return None
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != CACHE_VERSION:
+        return None
+    return manifest
+
+
+def write_cache(df, manifest, cache_path, manifest_path):
+    # Write to temporary files first so that concurrent readers never see a partial cache
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_suffix = '.' + str(os.getpid()) + '.tmp'
+    if df is not None:
+        df.to_parquet(cache_path + tmp_suffix, index=False)
+        os.replace(cache_path + tmp_suffix, cache_path)
+    with open(manifest_path + tmp_suffix, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + tmp_suffix, manifest_path)
+
+
+def read_csv_table(source_path, table):
+    schema = TABLE_SCHEMAS[table]
+    try:
+        return pd.read_csv(source_path, **schema)
+    except ValueError:
+        # Keys with missing values cannot be int32: fall back to nullable integers for this table
+        dtype = {column: 'Int32' if kind == 'int32' else kind for column, kind in schema['dtype'].items()}
+        return pd.read_csv(source_path, dtype=dtype, parse_dates=schema.get('parse_dates'))
+
+
+def read_table(path, table):
+    source_path = f'{path}/{table}.csv'
+    cache_path = f'{path}/{CACHE_FOLDER}/{table}.parquet'
+    manifest_path = f'{path}/{CACHE_FOLDER}/{table}.json'
+
+    signature = get_file_signature(source_path)
+    manifest = read_cache_manifest(manifest_path, cache_path)
+
+    # Same size and mtime: trust the cache. Same size but new mtime: the content hash decides
+    if manifest is not None and manifest['size'] == signature['size']:
+        if manifest['mtime'] == signature['mtime']:
+            return pd.read_parquet(cache_path)
+        if manifest['hash'] == get_file_hash(source_path):
+            manifest.update(signature)
+            try:
+                write_cache(None, manifest, cache_path, manifest_path)
+            except OSError:
+                pass
+            return pd.read_parquet(cache_path)
+
+    df = read_csv_table(source_path, table)
+    manifest = {'version': CACHE_VERSION, 'hash': get_file_hash(source_path), **signature}
+    try:
+        write_cache(df, manifest, cache_path, manifest_path)
+    except (OSError, ValueError, TypeError):
+        # Read-only data folder or a column pyarrow cannot store: serve the CSV data uncached
+        pass
+    return df
+
+
+def get_database_url(directory):
+    # A company is read from SQL when DATABASE_URL_<COMPANY> is set, e.g. sqlite:///data/demo.db for local tests
+    return os.environ.get('DATABASE_URL_' + re.sub(r'\W', '_', directory).upper())
+
+
+@st.cache_resource
+def get_engine(database_url):
+    return create_engine(database_url, pool_pre_ping=True, pool_recycle=3600)
+
+
+def apply_table_schema(df, table, dtype):
+    for column in df.columns.intersection(TABLE_SCHEMAS[table].get('parse_dates', [])):
+        df[column] = pd.to_datetime(df[column])
+    for column, kind in dtype.items():
+        if column not in df:
+            continue
+        if kind is str:
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+        elif kind == 'int32':
+            try:
+                df[column] = df[column].astype('int32')
+            except (ValueError, TypeError):
+                df[column] = df[column].astype('Int32')
+        else:
+            df[column] = df[column].astype(kind)
+    return df
+
+
+def read_sql_chunks(directory, table, query='SELECT * FROM {table}', params=None):
+    # Labels are left as strings: a categorical dtype is only shared by chunks once they are gathered
+    chunk_dtype = {column: kind for column, kind in TABLE_SCHEMAS[table]['dtype'].items() if kind != 'category'}
+
+    with get_engine(get_database_url(directory)).connect() as connection:
+        for chunk in pd.read_sql(text(query.format(table=table)), connection, params=params,
+                                 chunksize=SQL_CHUNK_SIZE):
+            yield apply_table_schema(chunk, table, chunk_dtype)
+
+
+def read_sql_table(directory, table, query='SELECT * FROM {table}', params=None):
+    dtype = TABLE_SCHEMAS[table]['dtype']
+    df = pd.concat(list(read_sql_chunks(directory, table, query, params)), ignore_index=True)
+    return df.astype({column: kind for column, kind in dtype.items() if kind == 'category' and column in df})
+
+
+def read_filtered_sql(directory, client_type, sales_filter, start_date, end_date, date_flag, client_flag):
+    # Customer type and date range are pushed down to the database instead of filtering full tables in memory
+    params = {'client_type': client_type, 'start_date': start_date, 'end_date': end_date}
+    customers_where = 'WHERE Customer_type = :client_type' if client_flag else ''
+    customers_query = 'SELECT * FROM {table} ' + customers_where
+
+    sales = []
+    for prefix in ['Invoice', 'Order']:
+        conditions = [f'Customer_ID IN (SELECT Customer_ID FROM Customers {customers_where})']
+        if date_flag:
+            conditions.append(f'{prefix}_date BETWEEN :start_date AND :end_date')
+        sales_where = 'WHERE ' + ' AND '.join(conditions)
+
+        sales.append(read_sql_table(directory, prefix + 's', 'SELECT * FROM {table} ' + sales_where +
+                                    f' ORDER BY {prefix}_date, {prefix}_ID', params))
+        sales.append(read_sql_table(directory, prefix + '_lines', 'SELECT * FROM {table} WHERE ' +
+                                    f'{prefix}_ID IN (SELECT {prefix}_ID FROM {prefix}s {sales_where})', params))
+    invoices, invoices_lines, orders, orders_lines = sales
+
+    customers = read_sql_table(directory, 'Customers', customers_query, params)
+    addresses = read_sql_table(directory, 'Addresses', 'SELECT * FROM {table} WHERE Customer_ID IN ' +
+                               '(SELECT Customer_ID FROM Customers ' + customers_where + ')', params)
+    categories = read_sql_table(directory, 'Categories')
+    products = read_sql_table(directory, 'Products', 'SELECT * FROM {table} WHERE Product_ID IN ' +
+                              f'(SELECT Product_ID FROM {sales_filter}_lines)')
+
+    return normalize_addresses(addresses), categories, customers, invoices, invoices_lines, orders, orders_lines, \
+        products
+
+
+def is_streaming(directory):
+    if get_database_url(directory):
+        return False
+    path = './data/' + directory
+    return any(os.path.getsize(f'{path}/{table}.csv') > MAX_LINES_FILE_SIZE for table in LINE_TABLES)
+
+
+def read_csv_chunks(directory, table, usecols):
+    dtype = {column: kind for column, kind in TABLE_SCHEMAS[table]['dtype'].items() if column in usecols}
+    return pd.read_csv(f'./data/{directory}/{table}.csv', usecols=usecols, dtype=dtype, chunksize=LINES_CHUNK_SIZE)
+
+
+def read_line_product_ids(directory, table):
+    product_ids = [chunk['Product_ID'].unique() for chunk in read_csv_chunks(directory, table, ['Product_ID'])]
+    return np.unique(np.concatenate(product_ids)) if product_ids else np.array([], dtype='int32')
+
+
+@st.cache_resource
 def get_data_from_csv(directory):
     path = './data/' + directory
-    address = pd.read_csv(f'{path}/Addresses.csv')
-    categories = pd.read_csv(f'{path}/Categories.csv')
-    customer = pd.read_csv(f'{path}/Customers.csv')
-    invoices = pd.read_csv(f'{path}/Invoices.csv')
-    invoices_lines = pd.read_csv(f'{path}/Invoice_lines.csv')
-    orders = pd.read_csv(f'{path}/Orders.csv')
-    orders_lines = pd.read_csv(f'{path}/Order_lines.csv')
-    products = pd.read_csv(f'{path}/Products.csv')
+    streaming = is_streaming(directory)
+    # In streaming mode only the header of the line tables is read, their content is aggregated chunk by chunk
+    address, categories, customer, invoices, invoices_lines, orders, orders_lines, products = [
+        pd.read_csv(f'{path}/{table}.csv', nrows=0, **TABLE_SCHEMAS[table]) if streaming and table in LINE_TABLES
+        else read_table(path, table) for table in TABLES]
     return address, categories, customer, invoices, invoices_lines, orders, orders_lines, products
 
 
+def share_frames(frames):
+    # Shallow copies: the app entry point turns copy-on-write on, so that writes to them never reach the cached frames
+    if isinstance(frames, pd.DataFrame):
+        return frames.copy(deep=False)
+    return tuple(df.copy(deep=False) for df in frames)
+
+
 @st.cache_data
-def transform_data(directory):
+def get_memory_report(directory):
+    tables = get_data_from_csv(directory)
+    report = pd.DataFrame({
+        'Table': TABLES,
+        'Rows': [len(df) for df in tables],
+        'Memory (MB)': [round(df.memory_usage(deep=True).sum() / 2 ** 20, 2) for df in tables],
+    })
+    return report.set_index('Table')
+
+
+def normalize_addresses(address):
+    address = address.dropna(subset=['Address_type'])
+    address_columns = address.loc[:, 'Address_1':].columns
+    address[address_columns] = address[address_columns].apply(
+        lambda x: x.astype(object).fillna('nan').astype(str).str.upper())
+    return address.drop_duplicates(
+        subset=['Customer_ID', 'Address_1', 'Address_2', 'Zip_code', 'City', 'Country', 'Address_type'])
+
+
+@st.cache_resource
+def load_transformed_data(directory):
     address, categories, customer, invoices, invoices_lines, orders, orders_lines, products = get_data_from_csv(
         directory)
 
-    invoices['Invoice_date'] = pd.to_datetime(invoices['Invoice_date'])
-    orders['Order_date'] = pd.to_datetime(orders['Order_date'])
+    invoices = invoices.assign(Invoice_date=pd.to_datetime(invoices['Invoice_date']))
+    orders = orders.assign(Order_date=pd.to_datetime(orders['Order_date']))
+
+    address = normalize_addresses(address)
 
     return address, categories, customer, invoices, invoices_lines, orders, orders_lines, products
 
 
+def transform_data(directory):
+    return share_frames(load_transformed_data(directory))
+
+
+@st.cache_resource
+def load_sales_headers(directory):
+    if get_database_url(directory):
+        return read_sql_table(directory, 'Invoices'), read_sql_table(directory, 'Orders')
+    _, _, _, invoices, _, orders, _, _ = transform_data(directory)
+    return invoices, orders
+
+
+def get_sales_headers(directory):
+    return share_frames(load_sales_headers(directory))
+
+
 @st.cache_data
 def get_dates(directory):
+    if get_database_url(directory):
+        invoice_dates = read_sql_table(directory, 'Invoices', 'SELECT MIN(Invoice_date) AS Invoice_date FROM {table} '
+                                                              'UNION ALL SELECT MAX(Invoice_date) FROM {table}')
+        order_dates = read_sql_table(directory, 'Orders', 'SELECT MIN(Order_date) AS Order_date FROM {table} '
+                                                          'UNION ALL SELECT MAX(Order_date) FROM {table}')
+        return min(invoice_dates['Invoice_date'].min(), order_dates['Order_date'].min()), max(
+            invoice_dates['Invoice_date'].max(), order_dates['Order_date'].max())
+
     address, categories, customer, invoices, invoices_lines, orders, orders_lines, products = transform_data(directory)
 
     DATE_MIN = min(invoices['Invoice_date'].min(), orders['Order_date'].min())
@@ -38,59 +309,401 @@ def get_dates(directory):
     return DATE_MIN, DATE_MAX
 
 
-@st.cache_data
-def filter_data(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag, client_flag):
-    addresses, categories, customers, invoices, invoices_lines, orders, orders_lines, products = transform_data(
-        directory)
+def build_sales_index(df_sales, df_lines, sales_filter):
+    # Sales sorted by date, and their lines grouped contiguously in the same order
+    df_sales = df_sales.iloc[np.argsort(df_sales[sales_filter + '_date'].to_numpy(), kind='stable')]
 
-    # Get Customers based on the filter
-    if client_flag:
-        customers = customers[(customers['Customer_type'] == client_type)]
+    sales_ids = df_sales[sales_filter + '_ID']
+    first_occurrences = ~sales_ids.duplicated().to_numpy()
+    parent_positions = pd.Index(sales_ids[first_occurrences]).get_indexer(df_lines[sales_filter + '_ID'])
+    parent_positions = np.where(parent_positions >= 0, np.flatnonzero(first_occurrences)[parent_positions], -1)
+
+    line_order = np.argsort(parent_positions, kind='stable')
+    line_order = line_order[parent_positions[line_order] >= 0]
+    line_counts = np.bincount(parent_positions[line_order], minlength=len(df_sales))
+
+    return {
+        'sales': df_sales,
+        'dates': df_sales[sales_filter + '_date'].to_numpy(),
+        'lines': df_lines.iloc[line_order],
+        'line_offsets': np.concatenate([[0], np.cumsum(line_counts)]),
+        'product_ids': df_lines['Product_ID'].unique(),
+    }
+
+
+@st.cache_resource
+def get_sales_index(directory):
+    _, _, _, invoices, invoices_lines, orders, orders_lines, _ = transform_data(directory)
+    sales_index = {
+        'Invoice': build_sales_index(invoices, invoices_lines, 'Invoice'),
+        'Order': build_sales_index(orders, orders_lines, 'Order'),
+    }
+    if is_streaming(directory):
+        for sales_filter in sales_index:
+            sales_index[sales_filter]['product_ids'] = read_line_product_ids(directory, sales_filter + '_lines')
+    return sales_index
+
+
+def gather_ranges(starts, ends):
+    lengths = ends - starts
+    return np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+
+
+def filter_sales(sales_index, start_date, end_date, customer_ids, date_flag):
+    df_sales = sales_index['sales']
+    line_offsets = sales_index['line_offsets']
+
+    if date_flag:
+        first = np.searchsorted(sales_index['dates'], np.datetime64(start_date), side='left')
+        last = np.searchsorted(sales_index['dates'], np.datetime64(end_date), side='right')
+    else:
+        first, last = 0, len(df_sales)
 
-    # Get Invoices and Orders within the Date Range
+    mask = df_sales['Customer_ID'].iloc[first:last].isin(customer_ids).to_numpy()
+    if mask.all():
+        df_lines = sales_index['lines'].iloc[line_offsets[first]:line_offsets[last]]
+        return df_sales.iloc[first:last], df_lines
+
+    positions = np.flatnonzero(mask) + first
+    df_lines = sales_index['lines'].iloc[gather_ranges(line_offsets[positions], line_offsets[positions + 1])]
+    return df_sales.iloc[positions], df_lines
+
+
+@st.cache_resource(max_entries=VIEW_CACHE_ENTRIES)
+def load_filtered_data(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag,
+                       client_flag):
     start_date = datetime.datetime(snapshot_start_date.year, snapshot_start_date.month, snapshot_start_date.day)
     end_date = datetime.datetime(snapshot_end_date.year, snapshot_end_date.month, snapshot_end_date.day)
 
-    if date_flag:
-        invoices = invoices[(invoices['Invoice_date'] >= start_date) &
-                            (invoices['Invoice_date'] <= end_date) &
-                            (invoices['Customer_ID'].isin(customers['Customer_ID']))]
-        orders = orders[(orders['Order_date'] >= start_date) &
-                        (orders['Order_date'] <= end_date) &
-                        (orders['Customer_ID'].isin(customers['Customer_ID']))]
+    if get_database_url(directory):
+        addresses, categories, customers, invoices, invoices_lines, orders, orders_lines, products = read_filtered_sql(
+            directory, client_type, sales_filter, start_date, end_date, date_flag, client_flag)
     else:
-        invoices = invoices[(invoices['Customer_ID'].isin(customers['Customer_ID']))]
-        orders = orders[(orders['Customer_ID'].isin(customers['Customer_ID']))]
+        addresses, categories, customers, _, _, _, _, products = transform_data(directory)
+        sales_index = get_sales_index(directory)
+
+        # Get Customers based on the filter
+        if client_flag:
+            customers = customers[(customers['Customer_type'] == client_type)]
+
+        # Get Invoices and Orders within the Date Range
+        invoices, invoices_lines = filter_sales(sales_index['Invoice'], start_date, end_date,
+                                                customers['Customer_ID'], date_flag)
+        orders, orders_lines = filter_sales(sales_index['Order'], start_date, end_date, customers['Customer_ID'],
+                                            date_flag)
+        products = products[products['Product_ID'].isin(sales_index[sales_filter]['product_ids'])]
 
     # Get All Data based on filters
     if sales_filter == 'Invoice':
         customers = customers[customers['Customer_ID'].isin(invoices['Customer_ID'])]
-        products = products[products['Product_ID'].isin(invoices_lines['Product_ID'])]
     else:
         customers = customers[customers['Customer_ID'].isin(orders['Customer_ID'])]
-        products = products[products['Product_ID'].isin(orders_lines['Product_ID'])]
 
-    invoices_lines = invoices_lines[invoices_lines['Invoice_ID'].isin(invoices['Invoice_ID'])]
-    orders_lines = orders_lines[orders_lines['Order_ID'].isin(orders['Order_ID'])]
     categories = categories[categories['Category_ID'].isin(products['Category_ID'])]
-    addresses = addresses[addresses['Customer_ID'].isin(customers['Customer_ID'])]
-
-    addresses.dropna(subset=['Address_type'], inplace=True)
-    addresses.loc[:, 'Address_1':] = addresses.loc[:, 'Address_1':].apply(lambda x: x.astype(str).str.upper())
-    addresses = addresses.drop_duplicates(
-        subset=['Customer_ID', 'Address_1', 'Address_2', 'Zip_code', 'City', 'Country', 'Address_type'])
 
-    invoice_addresses = pd.merge(invoices[['Invoice_address_ID', 'Invoice_date']],
-                                 addresses[addresses['Address_type'] == 'INVOICE'],
-                                 left_on='Invoice_address_ID',
-                                 right_on='Address_ID', how='right')
-    invoice_addresses['Rank'] = invoice_addresses.groupby('Customer_ID')['Invoice_date'].transform(
-        lambda x: x.rank(method='first', ascending=False))
-    invoice_addresses = invoice_addresses[invoice_addresses['Rank'] == 1].drop(columns=['Rank'])
+    # Keep, for each customer, the invoice address used by its most recent invoice, then all its other addresses
+    in_scope = addresses['Customer_ID'].isin(customers['Customer_ID']).to_numpy()
+    is_invoice_address = (addresses['Address_type'] == 'INVOICE').to_numpy()
+    last_invoice_dates = invoices.groupby('Invoice_address_ID')['Invoice_date'].max()
+    address_dates = addresses['Address_ID'].map(last_invoice_dates).to_numpy()
 
-    other_addresses = addresses[addresses['Address_type'] != 'INVOICE']
+    candidates = np.flatnonzero(in_scope & is_invoice_address & ~np.isnat(address_dates))
+    candidates = candidates[np.argsort(-address_dates[candidates].view('int64'), kind='stable')]
+    _, first_candidates = np.unique(addresses['Customer_ID'].to_numpy()[candidates], return_index=True)
+    selected = np.sort(candidates[first_candidates])
+    others = np.flatnonzero(in_scope & ~is_invoice_address)
 
-    addresses = pd.concat([invoice_addresses, other_addresses])
-    addresses.drop(['Invoice_address_ID', 'Invoice_date'], axis=1)
+    positions = np.concatenate([selected, others])
+    is_selected = np.arange(len(positions)) < len(selected)
+    addresses = addresses.iloc[positions].assign(
+        Invoice_address_ID=np.where(is_selected, addresses['Address_ID'].to_numpy()[positions], np.nan),
+        Invoice_date=np.where(is_selected, address_dates[positions], np.datetime64('NaT')))
 
     return addresses, categories, customers, invoices, invoices_lines, orders, orders_lines, products
+
+
+def filter_data(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag,
+                client_flag):
+    return share_frames(load_filtered_data(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory,
+                                           date_flag, client_flag))
+
+
+def build_sales_facts(df_sales, df_lines, products, categories, sales_filter):
+    facts = df_lines[[sales_filter + '_ID', 'Product_ID', 'Quantity', 'Total_price']].merge(
+        df_sales[[sales_filter + '_ID', 'Customer_ID', sales_filter + '_date']], on=sales_filter + '_ID')
+    facts = facts.rename(columns={sales_filter + '_ID': 'Sale_ID', sales_filter + '_date': 'Sale_date'})
+
+    # Lines of unknown products or categories are kept: each analysis drops them like its former inner joins did
+    facts = facts.merge(products[['Product_ID', 'Product_name', 'Category_ID']], on='Product_ID', how='left')
+    facts = facts.merge(categories[['Category_ID', 'Category_name']], on='Category_ID', how='left')
+
+    return facts[['Sale_ID', 'Customer_ID', 'Product_ID', 'Product_name', 'Category_ID', 'Category_name', 'Sale_date',
+                  'Quantity', 'Total_price']]
+
+
+@st.cache_resource(max_entries=VIEW_CACHE_ENTRIES)
+def load_sales_facts(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag,
+                     client_flag):
+    _, categories, _, invoices, invoices_lines, orders, orders_lines, products = filter_data(
+        client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag, client_flag)
+
+    if sales_filter == 'Invoice':
+        return build_sales_facts(invoices, invoices_lines, products, categories, sales_filter)
+    return build_sales_facts(orders, orders_lines, products, categories, sales_filter)
+
+
+def get_sales_facts(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag,
+                    client_flag):
+    return share_frames(load_sales_facts(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory,
+                                         date_flag, client_flag))
+
+
+def sum_sale_lines(line_chunks, sales_filter):
+    # Line count, quantity and total of each sale ID. Partial sums of an ID spread over several chunks are folded
+    # together
+    partials = [chunk.groupby(sales_filter + '_ID').agg(
+        Line_count=('Quantity', 'size'),
+        Quantity=('Quantity', 'sum'),
+        Line_total=('Total_price', 'sum')) for chunk in line_chunks]
+    return pd.concat(partials).groupby(level=0).sum().reset_index()
+
+
+@st.cache_resource
+def load_sale_lines(directory, sales_filter):
+    # Streaming mode: the over-sized line table is read once per company, every view then joins its sales to these
+    # per-sale totals in memory
+    return sum_sale_lines(read_csv_chunks(directory, sales_filter + '_lines',
+                                          [sales_filter + '_ID', 'Quantity', 'Total_price']), sales_filter)
+
+
+def get_sale_lines(directory, sales_filter, df_lines):
+    if is_streaming(directory):
+        return share_frames(load_sale_lines(directory, sales_filter))
+    return sum_sale_lines([df_lines], sales_filter)
+
+
+def aggregate_lines(sale_lines, df_sales, sales_filter):
+    lines = sale_lines.merge(df_sales[[sales_filter + '_ID', 'Customer_ID', sales_filter + '_date']],
+                             on=sales_filter + '_ID')
+    return lines.groupby('Customer_ID').agg(
+        Line_count=('Line_count', 'sum'),
+        Quantity=('Quantity', 'sum'),
+        Line_total=('Line_total', 'sum'),
+        First_line_date=(sales_filter + '_date', 'min'),
+        Last_line_date=(sales_filter + '_date', 'max'))
+
+
+@st.cache_resource(max_entries=VIEW_CACHE_ENTRIES)
+def load_customer_aggregates(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory,
+                             date_flag, client_flag):
+    _, _, _, invoices, invoices_lines, orders, orders_lines, _ = filter_data(
+        client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag, client_flag)
+
+    if sales_filter == 'Invoice':
+        df_sales, df_lines = invoices, invoices_lines
+    else:
+        df_sales, df_lines = orders, orders_lines
+
+    aggregates = df_sales.groupby('Customer_ID').agg(
+        Sale_count=(sales_filter + '_ID', 'size'),
+        First_sale_date=(sales_filter + '_date', 'min'),
+        Last_sale_date=(sales_filter + '_date', 'max'),
+        Sale_total=('Total_price', 'sum'))
+    sale_days = pd.DataFrame({'Customer_ID': df_sales['Customer_ID'].to_numpy(),
+                              'Day': df_sales[sales_filter + '_date'].to_numpy().astype('datetime64[D]')})
+    aggregates['Sale_days'] = sale_days.drop_duplicates().groupby('Customer_ID').size()
+    aggregates = aggregates.join(aggregate_lines(get_sale_lines(directory, sales_filter, df_lines), df_sales,
+                                                 sales_filter))
+    line_columns = ['Line_count', 'Quantity', 'Line_total']
+    aggregates[line_columns] = aggregates[line_columns].fillna(0)
+    aggregates['Line_count'] = aggregates['Line_count'].astype(int)
+
+    return aggregates.reset_index()
+
+
+def get_customer_aggregates(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag,
+                            client_flag):
+    return share_frames(load_customer_aggregates(client_type, sales_filter, snapshot_start_date, snapshot_end_date,
+                                                 directory, date_flag, client_flag))
+
+
+def aggregate_horizon_lines(sale_lines, df_sales, sales_filter, horizon_starts):
+    # The lines of each sale are added to the cell of its customer and of the shortest horizon holding the sale, the
+    # last cell of a customer holding the lines older than all horizons. Lines are linked to the first sale with their
+    # ID
+    sales_ids = df_sales[sales_filter + '_ID']
+    first_occurrences = ~sales_ids.duplicated().to_numpy()
+    sales_positions = pd.Index(sales_ids[first_occurrences])
+
+    customer_ids, customers = np.unique(df_sales['Customer_ID'].to_numpy()[first_occurrences], return_inverse=True)
+    nb_cells = len(horizon_starts) + 1
+    horizons = len(horizon_starts) - np.searchsorted(np.array(horizon_starts, dtype='datetime64[ns]'),
+                                                     df_sales[sales_filter + '_date'].to_numpy()[first_occurrences],
+                                                     side='right')
+    sales_cells = customers * nb_cells + horizons
+
+    positions = sales_positions.get_indexer(sale_lines[sales_filter + '_ID'])
+    found = positions >= 0
+    cells = sales_cells[positions[found]]
+    count, quantity, total = [np.bincount(cells, sale_lines[column].to_numpy(dtype=float)[found],
+                                          len(customer_ids) * nb_cells)
+                              for column in ['Line_count', 'Quantity', 'Line_total']]
+
+    cells = np.flatnonzero(count)
+    return pd.DataFrame({
+        'Customer_ID': customer_ids[cells // nb_cells],
+        'Horizon': cells % nb_cells,
+        'Line_count': count[cells].astype(int),
+        'Quantity': quantity[cells],
+        'Line_total': total[cells],
+    })
+
+
+@st.cache_resource(max_entries=VIEW_CACHE_ENTRIES)
+def load_horizon_aggregates(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag,
+                            client_flag, horizons):
+    # Both sources come from the same filtered data: sales_filter only picks the cache entry of the current view
+    _, _, _, invoices, invoices_lines, orders, orders_lines, _ = filter_data(
+        client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag, client_flag)
+
+    end_date = pd.Timestamp(snapshot_end_date)
+    horizon_starts = [end_date - pd.DateOffset(months=horizon) for horizon in sorted(horizons, reverse=True)]
+    aggregates = []
+    for source, df_sales, df_lines in [('Invoice', invoices, invoices_lines), ('Order', orders, orders_lines)]:
+        aggregates.append(aggregate_horizon_lines(get_sale_lines(directory, source, df_lines), df_sales, source,
+                                                  horizon_starts))
+
+    sources = np.repeat([0, 1], [len(df) for df in aggregates])
+    aggregates = pd.concat(aggregates, ignore_index=True)
+    aggregates['Source'] = pd.Categorical.from_codes(sources, ['Invoice', 'Order'])
+    return aggregates
+
+
+def get_horizon_aggregates(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag,
+                           client_flag, horizons):
+    return share_frames(load_horizon_aggregates(client_type, sales_filter, snapshot_start_date, snapshot_end_date,
+                                                directory, date_flag, client_flag, horizons))
+
+
+def aggregate_daily_sales(sales_chunks, customers, sales_filter):
+    # One row per customer and day, sorted by customer then day. Sales at midnight get their own half-day, as a date
+    # range ends at midnight of its last day
+    partials = []
+    for df_sales in sales_chunks:
+        df_sales = df_sales[df_sales['Customer_ID'].isin(customers['Customer_ID'])]
+        dates = df_sales[sales_filter + '_date'].to_numpy()
+        days = dates.astype('datetime64[D]')
+        partials.append(pd.DataFrame({
+            'Customer_ID': df_sales['Customer_ID'].to_numpy(),
+            'Half_day': 2 * days.astype(np.int64) + (dates != days),
+            'Date': dates,
+            'Total_price': df_sales['Total_price'].to_numpy(dtype=float),
+        }).groupby(['Customer_ID', 'Half_day']).agg(
+            Count=('Date', 'size'), Last_date=('Date', 'max'), Total=('Total_price', 'sum')))
+
+    # Days of a customer spread over several chunks are folded together
+    return pd.concat(partials).groupby(level=[0, 1]).agg(
+        {'Count': 'sum', 'Last_date': 'max', 'Total': 'sum'}).reset_index()
+
+
+def build_daily_aggregates(sales_chunks, customers, sales_filter):
+    daily = aggregate_daily_sales(sales_chunks, customers, sales_filter)
+
+    customer_ids, codes = np.unique(daily['Customer_ID'].to_numpy(), return_inverse=True)
+    half_days = daily['Half_day'].to_numpy()
+    first_half_day = half_days.min() if len(daily) else 0
+    span = (half_days.max() - first_half_day + 2) if len(daily) else 2
+
+    return {
+        'customer_ids': customer_ids,
+        'customer_types': {customer_type: np.isin(customer_ids, group['Customer_ID'])
+                           for customer_type, group in customers.groupby('Customer_type', observed=True)},
+        'offsets': np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(customer_ids)))]),
+        'keys': codes * span + half_days - first_half_day,
+        'first_half_day': first_half_day,
+        'span': span,
+        'last_dates': daily['Last_date'].to_numpy(),
+        # Sale counts run over the whole table, totals restart at each customer to keep the precision of its sums
+        'counts': np.concatenate([[0], np.cumsum(daily['Count'].to_numpy())]),
+        'totals': daily.groupby('Customer_ID')['Total'].cumsum().to_numpy(),
+    }
+
+
+@st.cache_resource
+def get_daily_aggregates(directory):
+    if get_database_url(directory):
+        customers = read_sql_table(directory, 'Customers', 'SELECT Customer_ID, Customer_type FROM {table}')
+        # Only the columns of the daily rows are fetched, and each chunk is folded before the next one is read
+        sales_chunks = {sales_filter: read_sql_chunks(
+            directory, sales_filter + 's', f'SELECT Customer_ID, {sales_filter}_date, Total_price FROM {{table}} '
+                                           'WHERE Customer_ID IN (SELECT Customer_ID FROM Customers)')
+            for sales_filter in ['Invoice', 'Order']}
+    else:
+        _, _, customers, invoices, _, orders, _, _ = transform_data(directory)
+        sales_chunks = {'Invoice': [invoices], 'Order': [orders]}
+    return {sales_filter: build_daily_aggregates(chunks, customers, sales_filter)
+            for sales_filter, chunks in sales_chunks.items()}
+
+
+def select_daily_customers(daily, client_type, client_flag):
+    codes = np.arange(len(daily['customer_ids']))
+    if client_flag:
+        codes = codes[daily['customer_types'].get(client_type, np.zeros(len(codes), bool))]
+    return codes
+
+
+def search_daily_bounds(daily, codes, snapshot_start_date, snapshot_end_dates):
+    # Rows of each customer within [start, end] for every end date, all the end dates being searched at once.
+    # Bounds beyond the first or last day of the data keep all the rows of the customers without searching
+    starts = daily['offsets'][codes]
+    first = starts
+    last = np.repeat(daily['offsets'][codes + 1][:, None], len(snapshot_end_dates), axis=1)
+
+    start = 2 * np.datetime64(snapshot_start_date, 'D').astype(np.int64) - daily['first_half_day']
+    ends = 2 * np.array(snapshot_end_dates, dtype='datetime64[D]').astype(np.int64) - daily['first_half_day']
+    if start > 0:
+        first = np.searchsorted(daily['keys'], codes * daily['span'] + min(start, daily['span'] - 1), side='left')
+    searched = ends < daily['span'] - 2
+    if searched.any():
+        last[:, searched] = np.searchsorted(
+            daily['keys'], (codes * daily['span'])[:, None] + np.maximum(ends[searched], -1), side='right')
+
+    return starts, first, last
+
+
+def read_daily_ranges(daily, codes, starts, first, last):
+    # Sale count, total and last date of each customer between two rows of its running totals
+    return pd.DataFrame({
+        'Customer_ID': daily['customer_ids'][codes],
+        'Sale_count': daily['counts'][last] - daily['counts'][first],
+        'Last_sale_date': daily['last_dates'][last - 1],
+        'Sale_total': daily['totals'][last - 1] - np.where(first > starts, daily['totals'][first - 1], 0),
+    }, copy=False)
+
+
+def get_rfm_aggregates(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, date_flag,
+                       client_flag):
+    daily = get_daily_aggregates(directory)[sales_filter]
+    codes = select_daily_customers(daily, client_type, client_flag)
+    if date_flag:
+        starts, first, last = search_daily_bounds(daily, codes, snapshot_start_date, [snapshot_end_date])
+        last = last[:, 0]
+    else:
+        starts = first = daily['offsets'][codes]
+        last = daily['offsets'][codes + 1]
+
+    in_range = last > first
+    return read_daily_ranges(daily, codes[in_range], starts[in_range], first[in_range], last[in_range])
+
+
+def get_rfm_history(client_type, sales_filter, snapshot_start_date, snapshot_end_dates, directory, client_flag):
+    # Same aggregates as get_rfm_aggregates for each end date, one block of customers per date
+    daily = get_daily_aggregates(directory)[sales_filter]
+    codes = select_daily_customers(daily, client_type, client_flag)
+    starts, first, last = search_daily_bounds(daily, codes, snapshot_start_date, snapshot_end_dates)
+
+    snapshots, customers = np.nonzero((last > first[:, None]).T)
+    history = read_daily_ranges(daily, codes[customers], starts[customers], first[customers],
+                                last[customers, snapshots])
+    history.insert(0, 'Snapshot_date', pd.to_datetime(np.array(snapshot_end_dates, dtype='datetime64[D]'))[snapshots])
+    return history
@@ -1,9 +1,35 @@
 import json
+import numpy as np
 import pandas as pd
 import streamlit as st
 import geopandas as gpd
 import plotly.express as px
+from scipy import optimize, special
+from sklearn.metrics import silhouette_score, silhouette_samples, davies_bouldin_score, calinski_harabasz_score
 from utils.data_viz import show_plots
+from utils.get_data import get_customer_aggregates, filter_data, gather_ranges, VIEW_CACHE_ENTRIES
+
+SILHOUETTE_SAMPLE_SIZE = 5000
+CLUSTER_SCORES = ['Automatic', 'Silhouette', 'Sampled silhouette', 'Davies-Bouldin', 'Calinski-Harabasz']
+CLTV_HORIZONS = (3, 6, 12)
+CLTV_MONTHS = 12
+CLTV_MARGIN = .10
+# Bounds of the parameters of the CLTV model, the scales alpha and v being in days and in the sales currency. q stays
+# above 1 for the average purchase value of the customers without repeat purchases to exist
+BGNBD_BOUNDS = [(1e-3, 1e3), (1e-3, 1e6), (1e-3, 1e3), (1e-3, 1e3)]
+GAMMA_GAMMA_BOUNDS = [(1e-3, 1e3), (1 + 1e-3, 1e3), (1e-3, 1e9)]
+DEPARTMENTS_GEOJSON = './utils/Geo/contour-des-departements.geojson'
+COUNTRIES_GEOJSON = './utils/Geo/curiexplore-pays.geojson'
+# Simplification tolerance of the GeoJSON layers in degrees, by zoom of the map: about a tenth of a pixel at that zoom
+GEO_TOLERANCES = {1: .05, 3.5: .005}
+
+# Centers of the departments and countries of the heatmap, numbered as the department part of zip codes and as alpha-2
+# country codes
+with open('./utils/Geo/GlobalMap/dpts.json') as f:
+    DEPARTMENT_CENTERS = pd.json_normalize(json.load(f)).drop(columns='nomLong')
+with open('./utils/Geo/GlobalMap/countries.json') as f:
+    COUNTRY_CENTERS = pd.json_normalize(json.load(f)).drop(columns=['numeric', 'alpha3']).rename(
+        columns={'country': 'nomShort', 'alpha2': 'numero', 'latitude': 'lat', 'longitude': 'lng'})
 
 
 @st.cache_data
@@ -19,88 +45,253 @@ def compute_kpis(invoices, orders, customers, categories, products, cltv_df):
     return show_plots(invoices, orders)
 
 
+def build_cltv_summary(customer_aggregates, snapshot_end_date):
+    # One transaction per purchase day, the times being in days: Frequency counts the repeat purchase days, Recency is
+    # the age of the customer at its last purchase day and T its age at the end of the date range
+    first_days = customer_aggregates['First_sale_date'].to_numpy().astype('datetime64[D]')
+    last_days = customer_aggregates['Last_sale_date'].to_numpy().astype('datetime64[D]')
+    end_day = np.datetime64(snapshot_end_date, 'D')
+    return pd.DataFrame({
+        'Customer_ID': customer_aggregates['Customer_ID'].to_numpy(),
+        'Frequency': customer_aggregates['Sale_days'].to_numpy() - 1,
+        'Recency': (last_days - first_days).astype(float),
+        'T': (end_day - first_days).astype(float),
+        'Monetary': customer_aggregates['Sale_total'].to_numpy() / customer_aggregates['Sale_days'].to_numpy(),
+    })
+
+
+def bgnbd_log_likelihood(r, alpha, a, b, counts, count_weights, x, t_x, T, weights):
+    # BG/NBD model of Fader, Hardie and Lee (2005). The terms depending on the number of repeat purchases only are
+    # computed once per distinct number, x being the positions of the summaries in counts
+    a1 = special.gammaln(r + counts) - special.gammaln(r) + r * np.log(alpha)
+    a2 = special.gammaln(a + b) + special.gammaln(b + counts) - special.gammaln(b) - special.gammaln(a + b + counts)
+    with np.errstate(divide='ignore'):
+        a4 = np.where(counts > 0, np.log(a) - np.log(np.maximum(b + counts - 1, 1e-12)), -np.inf)[x]
+    shape = r + counts[x]
+    return (np.dot(count_weights, a1 + a2) +
+            np.dot(weights, np.logaddexp(-shape * np.log(alpha + T), a4 - shape * np.log(alpha + t_x))))
+
+
+def gamma_gamma_log_likelihood(p, q, v, counts, count_weights, sum_x_log_m, sum_log_m, x, m):
+    # Gamma-Gamma model of the average purchase value, for customers with repeat purchases
+    a1 = (special.gammaln(p * counts + q) - special.gammaln(p * counts) - special.gammaln(q) + q * np.log(v) +
+          p * counts * np.log(counts))
+    return np.dot(count_weights, a1) + p * sum_x_log_m - sum_log_m - np.dot(p * x + q, np.log(x * m + v))
+
+
+def fit_log_likelihood(log_likelihood, initial_params, bounds, data, nb_customers):
+    # Parameters are fitted on their logarithm so that they stay positive. Without churn or without heterogeneity the
+    # likelihood keeps growing towards infinite parameters: the bounds stop them where the predictions stay accurate
+    def negative_log_likelihood(log_params):
+        return -log_likelihood(*np.exp(log_params), *data) / nb_customers
+
+    result = optimize.minimize(negative_log_likelihood, np.log(np.clip(initial_params, *np.array(bounds).T)),
+                               method='L-BFGS-B', bounds=np.log(bounds))
+    return np.exp(result.x)
+
+
+def fit_cltv_model(summary):
+    # Customers with the same whole-day summary share their likelihood: each distinct summary is evaluated once
+    x = summary['Frequency'].to_numpy(np.int64)
+    t_x = summary['Recency'].to_numpy().astype(np.int64)
+    T = summary['T'].to_numpy().astype(np.int64)
+    span = T.max() + 1 if len(T) else 1
+    keys, weights = np.unique((x * span + t_x) * span + T, return_counts=True)
+    x, t_x, T = keys // span ** 2, keys // span % span, keys % span
+    counts, x = np.unique(x, return_inverse=True)
+    r, alpha, a, b = fit_log_likelihood(bgnbd_log_likelihood, [1, T.mean(), 1, 1], BGNBD_BOUNDS,
+                                        (counts, np.bincount(x, weights), x, t_x, T, weights), weights.sum())
+
+    x = summary['Frequency'].to_numpy(float)
+    m = summary['Monetary'].to_numpy()
+    repeat = (x > 0) & (m > 0)
+    x, m = x[repeat], m[repeat]
+    if repeat.any():
+        counts, count_weights = np.unique(x, return_counts=True)
+        p, q, v = fit_log_likelihood(gamma_gamma_log_likelihood, [1, 1, m.mean()], GAMMA_GAMMA_BOUNDS,
+                                     (counts, count_weights, np.dot(x, np.log(m)), np.log(m).sum(), x, m), len(x))
+    else:
+        p, q, v = np.nan, np.nan, np.nan
+
+    return {'r': r, 'alpha': alpha, 'a': a, 'b': b, 'p': p, 'q': q, 'v': v}
+
+
+def predict_lifetime_value(summary, params, months=CLTV_MONTHS, margin=CLTV_MARGIN):
+    # Expected number of purchase days over the next months times the expected average value of a purchase day
+    r, alpha, a, b, p, q, v = [params[name] for name in ['r', 'alpha', 'a', 'b', 'p', 'q', 'v']]
+    x, t_x, T = summary['Frequency'].to_numpy(float), summary['Recency'].to_numpy(), summary['T'].to_numpy()
+    m = summary['Monetary'].to_numpy()
+    t = months * 365.25 / 12
+
+    hypergeometric = special.hyp2f1(r + x, b + x, a + b + x - 1, t / (alpha + T + t))
+    numerator = (a + b + x - 1) / (a - 1) * (1 - ((alpha + T) / (alpha + T + t)) ** (r + x) * hypergeometric)
+    denominator = 1 + (x > 0) * a / (b + x - 1) * ((alpha + T) / (alpha + t_x)) ** (r + x)
+    purchases = numerator / denominator
+
+    average_value = np.where(x > 0, (p * (v + x * m)) / (p * x + q - 1), p * v / (q - 1))
+    return purchases * average_value * margin
+
+
+@st.cache_data
+def get_cltv_model(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory):
+    customer_aggregates = get_customer_aggregates(client_type, sales_filter, snapshot_start_date, snapshot_end_date,
+                                                  directory, True, True)
+    return fit_cltv_model(build_cltv_summary(customer_aggregates, snapshot_end_date))
+
+
 @st.cache_data
-def compute_lifetime_value(df, df_lines, sales_filter):
-    df_final = df.merge(df_lines, left_on=sales_filter + '_ID', right_on=sales_filter + '_ID')
-
-    cltv_df = df_final.groupby('Customer_ID').agg(
-        {
-            sales_filter + '_date': lambda x: (x.max() - x.min()).days,
-            sales_filter + '_ID': lambda x: len(x),
-            'Quantity': lambda x: x.sum(),
-            'Total_price_y': lambda x: x.sum(),
-        }
-    )
-    cltv_df.columns = ['Age', 'Num_transactions', 'Quantity', 'Total_revenue']
-    cltv_df = cltv_df.reset_index()
-    cltv_df = cltv_df[cltv_df['Quantity'] > 0]
-    cltv_df['AOV'] = cltv_df['Total_revenue'] / cltv_df['Num_transactions']
-    purchase_freq = sum(cltv_df['Num_transactions']) / len(cltv_df)
-    repeat_rate = cltv_df[cltv_df['Num_transactions'] > 1].shape[0] / cltv_df.shape[0]
-    churn_rate = 1 - repeat_rate
-    cltv_df['CLTV'] = ((cltv_df['AOV'] * purchase_freq) / churn_rate) * .10
-    cltv_df = cltv_df[['Customer_ID', 'Age', 'CLTV']]
+def compute_lifetime_value(customer_aggregates, cltv_model, snapshot_end_date):
+    customer_aggregates = customer_aggregates[(customer_aggregates['Line_count'] > 0) &
+                                              (customer_aggregates['Quantity'] > 0)]
+    cltv_df = pd.DataFrame({
+        'Customer_ID': customer_aggregates['Customer_ID'],
+        'Age': (customer_aggregates['Last_line_date'] - customer_aggregates['First_line_date']).dt.days,
+        'CLTV': predict_lifetime_value(build_cltv_summary(customer_aggregates, snapshot_end_date), cltv_model),
+    })
 
     return cltv_df
 
 
-@st.cache_data
-def get_customers_heatmap(address):
-    with open('./utils/Geo/GlobalMap/countries.json') as c:
-        countries_data = json.load(c)
-    with open('./utils/Geo/GlobalMap/dpts.json', 'r') as f:
-        data = json.load(f)
+def compute_lifetime_values(horizon_aggregates, horizons=CLTV_HORIZONS, margin=CLTV_MARGIN):
+    # Legacy CLTV from the average purchase frequency and churn rate of the customers, for every source and every
+    # horizon at once: the customers, sources and horizon buckets are the axes of one array, and each horizon sums the
+    # buckets of the shorter ones
+    horizons = sorted(horizons)
+    customers, customer_ids = pd.factorize(horizon_aggregates['Customer_ID'], sort=True)
+    sources = horizon_aggregates['Source'].astype('category').cat
+    shape = (len(customer_ids), len(sources.categories), len(horizons) + 1)
+    cells = np.ravel_multi_index((customers, sources.codes.to_numpy(), horizon_aggregates['Horizon'].to_numpy()),
+                                 shape)
+
+    count, quantity, total = [np.bincount(cells, horizon_aggregates[column].to_numpy(dtype=float),
+                                          np.prod(shape)).reshape(shape)
+                              for column in ['Line_count', 'Quantity', 'Line_total']]
+    for values in [count, quantity, total]:
+        for horizon in range(1, shape[2]):
+            values[..., horizon] += values[..., horizon - 1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid = (count > 0) & (quantity > 0)
+        nb_valid = np.count_nonzero(valid, axis=0)
+        purchase_freq = count.sum(axis=0, where=valid) / nb_valid
+        churn_rate = 1 - np.count_nonzero(valid & (count > 1), axis=0) / nb_valid
+        cltv = np.divide(total, count, out=np.full(shape, np.nan), where=valid)
+        cltv *= (purchase_freq / churn_rate) * margin
+
+    columns = ['CLTV_' + source + '_' + horizon for source in sources.categories
+               for horizon in [str(horizon) + 'M' for horizon in horizons] + ['All']]
+    cltv_df = pd.DataFrame(cltv.reshape(len(customer_ids), -1), columns=columns)
+    cltv_df.insert(0, 'Customer_ID', customer_ids)
+
+    return cltv_df
+
+
+def select_cluster_score(key):
+    return st.selectbox('Cluster quality score', CLUSTER_SCORES, key=key,
+                        help='Automatic uses the exact silhouette up to ' + str(SILHOUETTE_SAMPLE_SIZE) +
+                             ' customers and a sampled silhouette above. Davies-Bouldin (lower is better) and '
+                             'Calinski-Harabasz (higher is better) only compare each customer to the centroids.')
+
+
+def sample_by_cluster(labels, sample_size, seed=0):
+    # Same share of every cluster in the sample as in the data, with at least one customer per cluster
+    rng = np.random.default_rng(seed)
+    order = np.argsort(labels, kind='stable')
+    _, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+    sizes = np.clip(np.round(counts * sample_size / len(labels)).astype(int), 1, counts)
+    return np.concatenate([rng.choice(order[start:start + count], size, replace=False)
+                           for start, count, size in zip(starts, counts, sizes)])
+
+
+def compute_cluster_score(features, labels, method):
+    features, labels = np.asarray(features), np.asarray(labels)
+    if method == 'Automatic':
+        method = 'Silhouette' if len(features) <= SILHOUETTE_SAMPLE_SIZE else 'Sampled silhouette'
+
+    if method == 'Silhouette':
+        return 'Silhouette score', silhouette_score(features, labels, metric='euclidean'), None
+    if method == 'Sampled silhouette':
+        sample = sample_by_cluster(labels, SILHOUETTE_SAMPLE_SIZE)
+        scores = silhouette_samples(features[sample], labels[sample], metric='euclidean')
+        margin = 1.96 * scores.std(ddof=1) / np.sqrt(len(scores))
+        name = 'Silhouette score (sample of ' + str(len(sample)) + ' out of ' + str(len(features)) + ' customers)'
+        return name, scores.mean(), (scores.mean() - margin, scores.mean() + margin)
+    if method == 'Davies-Bouldin':
+        return 'Davies-Bouldin index', davies_bouldin_score(features, labels), None
+    return 'Calinski-Harabasz index', calinski_harabasz_score(features, labels), None
+
 
-    corsica = pd.read_csv('utils/Geo/base-officielle-codes-postaux.csv')
-    zip_codes = address.drop_duplicates()
+def show_cluster_score(name, score, interval):
+    message = name + ' : ' + str(round(score, 2))
+    if interval is not None:
+        message += ' (95% confidence interval: ' + str(round(interval[0], 2)) + ' to ' + str(
+            round(interval[1], 2)) + ')'
+    st.success(message)
 
+
+@st.cache_resource
+def get_corsica_departments():
+    # Postal codes of Corsica, whose departments 2A and 2B are not the first two digits of their postal codes
+    postal_codes = pd.read_csv('utils/Geo/base-officielle-codes-postaux.csv',
+                               usecols=['code_commune_insee', 'code_postal'], dtype=str)
+    postal_codes = postal_codes[postal_codes['code_commune_insee'].str.startswith(('2A', '2B'))]
+    postal_codes = postal_codes.drop_duplicates('code_postal')
+    return dict(zip(postal_codes['code_postal'], postal_codes['code_commune_insee'].str[:2]))
+
+
+def map_corsica_departments(zip_codes):
+    zip_codes = zip_codes.astype(str)
+    return zip_codes.map(get_corsica_departments()).fillna(zip_codes)
+
+
+@st.cache_resource
+def load_geo_layer(path, zoom):
+    # Parsed and simplified once per process, then kept as GeoJSON features by code, ready to be sent to plotly
+    layer = gpd.read_file(path)
+    layer['geometry'] = layer.simplify(GEO_TOLERANCES[zoom], preserve_topology=True)
+    return {feature['properties']['code']: feature for feature in json.loads(layer.to_json(drop_id=True))['features']}
+
+
+def get_geo_layer(path, zoom, codes):
+    # Only the features of the selection are shipped with the figure
+    features = load_geo_layer(path, zoom)
+    return {'type': 'FeatureCollection', 'features': [features[code] for code in pd.unique(codes) if code in features]}
+
+
+def get_geo_codes(address):
+    # Department of the French addresses and country of the others, as numbered in the centers of the heatmap. Zip
+    # codes are normalized once per distinct pair of zip code and country rather than once per address
+    zip_codes = address[['Zip_code', 'Country']].drop_duplicates()
     mask = (zip_codes['Country'] != 'FR') & (~zip_codes['Country'].isnull())
-    zip_codes.loc[mask, 'Zip_code'] = zip_codes.loc[mask, 'Country']
-    zip_codes = zip_codes.dropna(subset=['Zip_code', 'City', 'Country'])
-
-    selected_entries = corsica[corsica['code_commune_insee'].str.startswith(('2A', '2B'))]
-    selected_entries.loc[:, 'nom_de_la_commune'] = selected_entries['nom_de_la_commune'].str.replace(' ',
-                                                                                                     '-').str.capitalize()
-    selected_entries.loc[:, 'code_commune_insee'] = selected_entries['code_commune_insee'].str[:2]
-    zip_codes['Zip_code'] = zip_codes['Zip_code'].astype(str)
-    selected_entries.loc[:, 'code_postal'] = selected_entries['code_postal'].astype(str)
-    zip_codes['Zip_code'] = zip_codes.apply(
-        lambda row: selected_entries.loc[
-            (selected_entries['code_postal'] == row['Zip_code']), 'code_commune_insee'].values[0]
-        if any(selected_entries['code_postal'] == row['Zip_code'])
-        else row['Zip_code'],
-        axis=1
-    )
-
-    zip_codes['Zip_code'] = zip_codes['Zip_code'].str[:2]
-    result = zip_codes.groupby('Zip_code').size().reset_index(name='Count')
-    result['Zip_code'] = result['Zip_code'].apply(lambda x: x[1:] if len(x) == 2 and x.startswith('0') else x)
-
-    country_json_copie = list(countries_data.copy())
-    gps_json_copie = list(data.copy())
-
-    zip_coder = result['Zip_code'].unique()
-    gps_json_copie = [item for item in gps_json_copie if item['numero'] in zip_coder]
-    country_json_copie = [item for item in country_json_copie if item['alpha2'] in zip_coder]
-
-    df_gps = pd.json_normalize(gps_json_copie)
-    df_countries = pd.json_normalize(country_json_copie)
-    df_countries_renamed = df_countries.rename(columns={'latitude': 'lat', 'longitude': 'lng', 'alpha2': 'numero'})
-
-    result['Zip_code'] = result['Zip_code'].astype(str)
-
-    merged_df_dpts = pd.merge(df_gps, result, how='left', left_on='numero', right_on='Zip_code')
-    merged_df_dpts_dropped = merged_df_dpts.drop('nomLong', axis=1)
-
-    if not df_countries_renamed.empty:
-        merged_df_countries = pd.merge(df_countries_renamed, result, how='left', left_on='numero', right_on='Zip_code')
-        merged_df_countries_dropped = merged_df_countries.drop(columns=['numeric', 'alpha3'])
-        merged_df_countries_dropped = merged_df_countries_dropped.rename(columns={'country': 'nomShort'})
-        result = pd.concat([merged_df_countries_dropped, merged_df_dpts_dropped], ignore_index=True)
+    zip_codes['Geo_code'] = zip_codes['Zip_code'].mask(mask, zip_codes['Country'])
+    zip_codes = zip_codes.dropna(subset=['Geo_code', 'Country'])
+    zip_codes['Geo_code'] = map_corsica_departments(zip_codes['Geo_code']).str[:2]
+    zip_codes['Geo_code'] = zip_codes['Geo_code'].str.replace(r'^0(?=.$)', '', regex=True)
+    return address.dropna(subset=['City']).merge(zip_codes, on=['Zip_code', 'Country'])
+
+
+@st.cache_data
+def get_geo_cube(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory):
+    # Address counts of a view by department or country and address type: the maps of the address types are sums of
+    # its columns
+    address = filter_data(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, True, True)[0]
+    address = address[['Zip_code', 'City', 'Country', 'Address_type']]
+    return get_geo_codes(address).groupby(['Geo_code', 'Address_type'], observed=True).size().unstack(fill_value=0)
+
+
+@st.cache_data
+def get_customers_heatmap(geo_cube, address_types):
+    counts = geo_cube.reindex(columns=address_types, fill_value=0).sum(axis=1)
+    counts = counts[counts > 0].rename('Count')
+    departments = DEPARTMENT_CENTERS.merge(counts, left_on='numero', right_index=True)
+    countries = COUNTRY_CENTERS.merge(counts, left_on='numero', right_index=True)
+
+    if not countries.empty:
+        result = pd.concat([countries, departments], ignore_index=True)
         zoom = 1
         center = 0
     else:
-        result = merged_df_dpts_dropped
+        result = departments
         zoom = 5
         center = {'lat': 46.6031, 'lon': 1.7394}
 
@@ -123,35 +314,42 @@ def get_customers_heatmap(address):
     return fig
 
 
-@st.cache_data
-def get_customer_location(address, customer_id):
-    corsica = pd.read_csv('utils/Geo/base-officielle-codes-postaux.csv')
-
-    selected_entries = corsica[corsica['code_commune_insee'].str.startswith(('2A', '2B'))]
-    selected_entries.loc[:, 'nom_de_la_commune'] = selected_entries['nom_de_la_commune'].str.replace(' ',
-                                                                                                     '-').str.capitalize()
-    selected_entries.loc[:, 'code_commune_insee'] = selected_entries['code_commune_insee'].str[:2]
-
-    address['Zip_code'] = address['Zip_code'].astype(str)
-    selected_entries.loc[:, 'code_postal'] = selected_entries['code_postal'].astype(str)
-
-    address['Zip_code'] = address.apply(
-        lambda row: selected_entries.loc[
-            (selected_entries['code_postal'] == row['Zip_code']), 'code_commune_insee'].values[0]
-        if any(selected_entries['code_postal'] == row['Zip_code'])
-        else row['Zip_code'],
-        axis=1
-    )
+@st.cache_resource(max_entries=VIEW_CACHE_ENTRIES)
+def get_address_store(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory):
+    # Addresses of a view sorted by customer, with the department part of their zip codes: the addresses of a customer
+    # are the rows between two of its offsets
+    address = filter_data(client_type, sales_filter, snapshot_start_date, snapshot_end_date, directory, True, True)[0]
+    positions = np.argsort(address['Customer_ID'].to_numpy(), kind='stable')
+    address = address[['Customer_ID', 'Zip_code', 'City', 'Country', 'Address_type']].iloc[positions]
+    address['Zip_code'] = map_corsica_departments(address['Zip_code']).str[:2]
+    address['City'] = address['City'].str.replace(' ', '-').str.capitalize()
+    customer_ids, counts = np.unique(address['Customer_ID'].to_numpy(), return_counts=True)
+    return {
+        'addresses': address.reset_index(drop=True),
+        'positions': positions,
+        'customer_ids': customer_ids,
+        'offsets': np.concatenate([[0], np.cumsum(counts)]),
+    }
+
+
+def get_customer_addresses(address_store, customer_ids):
+    # The rows are put back in the order of the view, which sets the colors of the address types on the maps
+    customer_ids = np.unique(customer_ids)
+    codes = np.searchsorted(address_store['customer_ids'], customer_ids)
+    found = codes < len(address_store['customer_ids'])
+    found[found] = address_store['customer_ids'][codes[found]] == customer_ids[found]
+    codes = codes[found]
+    rows = gather_ranges(address_store['offsets'][codes], address_store['offsets'][codes + 1])
+    rows = rows[np.argsort(address_store['positions'][rows], kind='stable')]
+    return address_store['addresses'].iloc[rows]
 
-    customer_zip = address[address['Customer_ID'] == customer_id]
-    customer_zip.loc[:, 'Zip_code'] = customer_zip['Zip_code'].str[:2]
-    customer_zip.loc[:, 'City'] = customer_zip['City'].str.replace(' ', '-').str.capitalize()
 
+@st.cache_data
+def get_customer_location(customer_zip):
     if (customer_zip['Country'] == 'FR').any():
-        geojson_france = './utils/Geo/contour-des-departements.geojson'
-        gdf_departements = gpd.read_file(geojson_france)
-
-        france_map = px.choropleth_mapbox(customer_zip, geojson=gdf_departements, locations='Zip_code',
+        france_map = px.choropleth_mapbox(customer_zip,
+                                          geojson=get_geo_layer(DEPARTMENTS_GEOJSON, 3.5, customer_zip['Zip_code']),
+                                          locations='Zip_code',
                                           featureidkey='properties.code',
                                           color='Address_type',
                                           color_continuous_scale='Viridis',
@@ -163,12 +361,9 @@ def get_customer_location(address, customer_id):
         return st.write(france_map)
 
     else:
-        geojson_world = './utils/Geo/curiexplore-pays.geojson'
-        gdf_departements2 = gpd.read_file(geojson_world)
-        gdf_occurences2 = gdf_departements2.merge(customer_zip['Country'], how='left', left_on='code',
-                                                  right_on='Country')
-        gdf_occurences2['Country'] = gdf_occurences2['Country'].fillna(0)
-        world_map = px.choropleth_mapbox(customer_zip, geojson=gdf_occurences2, locations='Country',
+        world_map = px.choropleth_mapbox(customer_zip,
+                                         geojson=get_geo_layer(COUNTRIES_GEOJSON, 1, customer_zip['Country']),
+                                         locations='Country',
                                          color='Address_type',
                                          featureidkey='properties.code',
                                          color_continuous_scale='Viridis',
@@ -181,34 +376,11 @@ def get_customer_location(address, customer_id):
 
 
 @st.cache_data
-def get_cluster_location(address, customer_ids):
-    corsica = pd.read_csv('utils/Geo/base-officielle-codes-postaux.csv')
-
-    selected_entries = corsica[corsica['code_commune_insee'].str.startswith(('2A', '2B'))]
-    selected_entries.loc[:, 'nom_de_la_commune'] = selected_entries['nom_de_la_commune'].str.replace(' ',
-                                                                                                     '-').str.capitalize()
-    selected_entries.loc[:, 'code_commune_insee'] = selected_entries['code_commune_insee'].str[:2]
-
-    address['Zip_code'] = address['Zip_code'].astype(str)
-    selected_entries.loc[:, 'code_postal'] = selected_entries['code_postal'].astype(str)
-
-    address['Zip_code'] = address.apply(
-        lambda row: selected_entries.loc[
-            (selected_entries['code_postal'] == row['Zip_code']), 'code_commune_insee'].values[0]
-        if any(selected_entries['code_postal'] == row['Zip_code'])
-        else row['Zip_code'],
-        axis=1
-    )
-
-    customer_zips = address[address['Customer_ID'].isin(customer_ids)]
-    customer_zips.loc[:, 'Zip_code'] = customer_zips['Zip_code'].str[:2]
-    customer_zips.loc[:, 'City'] = customer_zips['City'].str.replace(' ', '-').str.capitalize()
-
-    geojson_france = './utils/Geo/contour-des-departements.geojson'
-    gdf_departements = gpd.read_file(geojson_france)
-
-    france_map = px.choropleth_mapbox(customer_zips[customer_zips['Country'] == 'FR'],
-                                      geojson=gdf_departements, locations='Zip_code',
+def get_cluster_location(customer_zips):
+    france_zips = customer_zips[customer_zips['Country'] == 'FR']
+    france_map = px.choropleth_mapbox(france_zips,
+                                      geojson=get_geo_layer(DEPARTMENTS_GEOJSON, 3.5, france_zips['Zip_code']),
+                                      locations='Zip_code',
                                       featureidkey='properties.code',
                                       color='Address_type',
                                       color_continuous_scale='Viridis',
@@ -220,12 +392,9 @@ def get_cluster_location(address, customer_ids):
     france_map.update_layout(title='Cluster Location in France')
     st.write(france_map)
 
-    geojson_world = './utils/Geo/curiexplore-pays.geojson'
-    gdf_departements2 = gpd.read_file(geojson_world)
-    gdf_occurences2 = gdf_departements2.merge(customer_zips['Country'], how='left', left_on='code',
-                                              right_on='Country')
-    gdf_occurences2['Country'] = gdf_occurences2['Country'].fillna(0)
-    world_map = px.choropleth_mapbox(customer_zips[customer_zips['Country'] != 'FR'], geojson=gdf_occurences2,
+    world_zips = customer_zips[customer_zips['Country'] != 'FR']
+    world_map = px.choropleth_mapbox(world_zips,
+                                     geojson=get_geo_layer(COUNTRIES_GEOJSON, 1, world_zips['Country']),
                                      locations='Country',
                                      color='Address_type',
                                      featureidkey='properties.code',
@@ -236,7 +405,7 @@ def get_cluster_location(address, customer_ids):
                                      opacity=0.8,
                                      )
     world_map.update_layout(title='Cluster Location worldwide')
-    if not customer_zips[customer_zips['Country'] != 'FR'].empty:
+    if not world_zips.empty:
         st.write(world_map)
 
     return france_map, world_map
@@ -0,0 +1,117 @@
+import os
+import time
+import itertools
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from streamlit.logger import get_logger
+from streamlit.runtime.scriptrunner import ScriptRunContext, add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.state import SafeSessionState, SessionState
+from utils.get_data import get_dates, filter_data, get_customer_aggregates, get_daily_aggregates, get_sales_facts, \
+    get_horizon_aggregates, is_streaming
+from utils.utility_functions import compute_lifetime_value, get_cltv_model, get_geo_cube, get_address_store, \
+    CLTV_HORIZONS
+from product_affinity_functions import clean_data as get_basket_features, generate_umap
+from most_frequent_pattern import clean_data as get_basket_items
+from rfm_segmentation_functions import get_rfm_segments, clean_data as get_rfm_features, get_features_fingerprint, \
+    fit_kmeans_sweep
+
+logger = get_logger(__name__)
+
+# Required fields of ScriptRunContext in the Streamlit version pinned in requirements.txt
+WARM_UP_CONTEXT_FIELDS = {'session_id', '_enqueue', 'query_string', 'session_state', 'uploaded_file_mgr',
+                          'main_script_path', 'page_script_hash', 'user_info'}
+
+
+def timed_step(directory, step, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    logger.info('Warm-up %s: %s in %.2f s', directory, step, time.perf_counter() - start)
+    return result
+
+
+def warm_up_company(directory):
+    # Same keys as the default view of the sidebar: Invoice data over the full date range
+    start = time.perf_counter()
+    date_min, date_max = timed_step(directory, 'dates', get_dates, directory)
+    date_min, date_max = date_min.date(), date_max.date()
+    timed_step(directory, 'daily aggregates', get_daily_aggregates, directory)
+
+    for customer_type in ['B2B', 'B2C']:
+        view = (customer_type, 'Invoice', date_min, date_max, directory)
+        timed_step(directory, customer_type + ' filtered data', filter_data, *view, True, True)
+        customer_aggregates = timed_step(directory, customer_type + ' customer aggregates', get_customer_aggregates,
+                                         *view, True, True)
+        cltv_model = timed_step(directory, customer_type + ' lifetime value model', get_cltv_model, *view)
+        timed_step(directory, customer_type + ' lifetime value', compute_lifetime_value, customer_aggregates,
+                   cltv_model, date_max)
+        timed_step(directory, customer_type + ' lifetime value horizons', get_horizon_aggregates, *view, True, True,
+                   CLTV_HORIZONS)
+        timed_step(directory, customer_type + ' geographic cube', get_geo_cube, *view)
+        rfm, _ = timed_step(directory, customer_type + ' RFM segments', get_rfm_segments, *view)
+        rfm_features, _ = timed_step(directory, customer_type + ' RFM features', get_rfm_features, rfm)
+        timed_step(directory, customer_type + ' RFM KMeans sweep', fit_kmeans_sweep,
+                   get_features_fingerprint(rfm_features), rfm_features)
+
+        if is_streaming(directory):
+            continue
+        timed_step(directory, customer_type + ' address store', get_address_store, *view)
+        sales_facts = timed_step(directory, customer_type + ' sales facts', get_sales_facts, *view, False, False)
+        product_features, _ = timed_step(directory, customer_type + ' basket features', get_basket_features,
+                                         sales_facts, 'Quantity')
+        timed_step(directory, customer_type + ' UMAP', generate_umap, product_features)
+        for mode in ['Product', 'Category']:
+            timed_step(directory, customer_type + ' ' + mode.lower() + ' baskets', get_basket_items, sales_facts, mode)
+
+    return time.perf_counter() - start
+
+
+def run_warm_up(directory, completed, total):
+    try:
+        duration = warm_up_company(directory)
+    except Exception:
+        logger.exception('Warm-up %s failed', directory)
+        return None
+    logger.info('Warm-up %s done in %.2f s (%d/%d companies)', directory, duration, next(completed), total)
+    return duration
+
+
+def create_warm_up_context(ctx):
+    # A context of its own, with an empty session state and no page to draw on. Built field by field, so that a
+    # Streamlit release with other required fields skips the warm-up instead of running with a half-built context
+    required_fields = {field.name for field in dataclasses.fields(ScriptRunContext)
+                       if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING}
+    if required_fields != WARM_UP_CONTEXT_FIELDS:
+        return None
+    return ScriptRunContext(
+        session_id='warm_up',
+        _enqueue=lambda msg: None,
+        query_string='',
+        session_state=SafeSessionState(SessionState(), lambda: None),
+        uploaded_file_mgr=ctx.uploaded_file_mgr,
+        main_script_path=ctx.main_script_path,
+        page_script_hash=ctx.page_script_hash,
+        user_info={})
+
+
+@st.cache_resource(show_spinner=False)
+def start_warm_up(directories):
+    # Runs once per process, on the first session, when WARM_UP is set in the environment
+    if os.environ.get('WARM_UP', '').lower() not in ['1', 'true', 'yes'] or not directories:
+        return None
+
+    # Caches are only written from a thread with a script context: each worker gets one that is not tied to any
+    # session, so that neither the spinners of cache misses nor the session state of the first visitor are touched
+    ctx = get_script_run_ctx()
+    if ctx is None or create_warm_up_context(ctx) is None:
+        logger.warning('Warm-up skipped: no script context can be created for its workers')
+        return None
+
+    workers = min(int(os.environ.get('WARM_UP_WORKERS', 4)), len(directories))
+    logger.info('Warm-up of %d companies with %d workers', len(directories), workers)
+    executor = ThreadPoolExecutor(workers, thread_name_prefix='warm_up',
+                                  initializer=lambda: add_script_run_ctx(ctx=create_warm_up_context(ctx)))
+    completed = itertools.count(1)
+    futures = [executor.submit(run_warm_up, directory, completed, len(directories)) for directory in directories]
+    executor.shutdown(wait=False)
+    return futures